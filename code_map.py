@@ -3,12 +3,17 @@ import sublime_plugin
 import os
 import shutil
 import sys
+import time
 import zipfile
+from bisect import bisect_right
 from os import path
 from sublime import Region
 from importlib.machinery import SourceFileLoader
 from .code_map_support import NavigateCodeMap as Nav
 from . import code_map_support as Mapper
+from .code_map_cache import map_cache
+from .code_map_index import project_index
+from .code_map_worker import map_worker
 
 # version = 1.0.19
 
@@ -21,30 +26,22 @@ py_syntax = 'Packages/Python/Python.tmLanguage'
 md_syntax = 'Packages/Markdown/Markdown.sublime-syntax'
 cs_syntax = 'Packages/C#/C#.tmLanguage'
 txt_syntax = 'Packages/Text/Plain text.tmLanguage'
-CUSTOM_MAPPERS = None
-ACTIVE = False
-TEMP_VIDS = []
-TEMP_VIEWS = {}
-CURRENT_TEMP_ID = None
 code_map_file = None
 
 # -------------------------
 
 
 def plugin_loaded():
-    global ACTIVE, CUSTOM_MAPPERS, using_universal_mapper, code_map_file
-
-    map_view = get_code_map_view()
-    if map_view:
-        ACTIVE = True
-        CodeMapListener.map_group = win().get_view_index(map_view)[0]
+    global using_universal_mapper, code_map_file
 
     using_universal_mapper = True
     code_map_file = path.join(sublime.packages_path(), 'User', 'CodeMap', 'Code - Map')
 
     default_mappers = ['md', 'py', 'ts']
     custom_languages = ['md']
-    Mapper.DEPTH = [settings().get('depth'), {}]
+    Mapper.DEPTH = [settings().get('depth'), Mapper.lru_map(500)]
+    Mapper.mapper_profiles.watch()
+    caret_follower.watch()
 
     user_folder = path.join(sublime.packages_path(), 'User')
     dst = path.join(user_folder, 'CodeMap')
@@ -91,6 +88,12 @@ def plugin_loaded():
         if not path.isfile(dst + os.sep + 'Default.sublime-keymap'):
             zip.extract('Default.sublime-keymap', dst)
 
+        # the project index workers run the package modules outside of the editor
+        indexer_dir = path.join(dst, 'indexer')
+        for module in ('code_map_support.py', 'tools/sublime.py', 'tools/index_project.py'):
+            zip.extract(module, indexer_dir)
+        project_index.worker = path.join(indexer_dir, 'tools', 'index_project.py')
+
     else:
         # package was installed manually
         plugin_dir = path.dirname(__file__)
@@ -113,8 +116,7 @@ def plugin_loaded():
             dst_keymap = path.join(dst, 'Default.sublime-keymap')
             shutil.copyfile(src_keymap, dst_keymap)
 
-    # make a list of the available mappers
-    CUSTOM_MAPPERS = os.listdir(mpdir)
+        project_index.worker = path.join(plugin_dir, 'tools', 'index_project.py')
 
     # reactivate on start-up
     reactivate()
@@ -122,6 +124,15 @@ def plugin_loaded():
 # -------------------------
 
 
+def plugin_unloaded():
+    Mapper.mapper_profiles.unwatch()
+    caret_follower.unwatch()
+    map_worker.stop()
+    project_index.stop()
+
+# -------------------------
+
+
 def is_compressed_package():
     plugin_dir = path.dirname(__file__)
     return not plugin_dir.startswith(sublime.packages_path())
@@ -154,40 +165,159 @@ def get_group(view):
 
 
 def reactivate():
-    global ACTIVE
+    map_windows.prune()
 
     map_view = get_code_map_view()
     if map_view:
-        CodeMapListener.map_group = win().get_view_index(map_view)[0]
+        state = map_windows.get()
+        state.map_group = win().get_view_index(map_view)[0]
         map_view.show(0)    # scroll up the map
-        ACTIVE = True
+        state.active = True
+
+# -------------------------
+
+
+class window_state():
+    """CodeMap state of a window (see `map_windows`)."""
+
+    def __init__(self):
+        self.active = False         # the map view is opened
+        self.map_view = None
+        self.map_group = None
+        self.active_view = None     # the view the map was last generated for
+        self.searched = False       # the views of the window have been searched for the map view
+
+        self.source = None          # the file (or the id of the temporary view) the map shows
+        self.temp_id = None         # the id of the temporary view the map shows
+        self.temp_views = Mapper.lru_map(50)
+        self.positions = Mapper.lru_map(200)    # source -> (viewport position, selection) of its map
+
+        # records of the map (see Mapper.symbol) and the record of every map row
+        self.symbols, self.rows = [], {}
+
+        # source line numbers of the map entries (sorted) and the matching map line regions
+        self.index_lines, self.index_regions = [], []
+
+        self.entry = -1             # index of the map entry highlighted by the caret follower
+
+        self.temp_vids = set()      # ids of the views mapped from their content (see refresh_map_for)
+
+        # map navigation (see navigate_code_map)
+        self.nav_view, self.navigating, self.skip = None, False, False
+
+
+class map_windows():
+    """Registry of the CodeMap state of every window (by window id).
+
+    The map view is registered when the map is opened, loaded or activated and forgotten when it
+    is closed, so finding it doesn't need to go through all the views of the window. The views are
+    searched only once if the map view isn't known (e.g. restored with the session)."""
+
+    states = {}
+
+    # -----------------
+
+    def get(window=None):
+        window = window or win()
+        window_id = window.id() if window else None
+        state = map_windows.states.get(window_id)
+        if state is None:
+            state = map_windows.states[window_id] = window_state()
+        return state
+
+    def of(view):
+        return map_windows.get(view.window())
+
+    def register(map_view):
+        state = map_windows.of(map_view)
+        state.map_view, state.searched = map_view, True
+        return state
+
+    def forget(window=None):
+        state = map_windows.get(window)
+        state.map_view, state.searched = None, False
+
+    def prune():
+        # the states of the closed windows
+        window_ids = set(w.id() for w in sublime.windows())
+        for window_id in list(map_windows.states):
+            if window_id not in window_ids:
+                del map_windows.states[window_id]
 
 # -------------------------
 
 
+def is_active(window=None):
+    return map_windows.get(window).active
+
 def is_code_map(view):
-    return view.file_name() == code_map_file
+    return is_map_file(view.file_name())
+
+def is_map_file(file):
+    # the map file of any window (see map_file_of), or the single map file of the older versions
+    return bool(file) and path.basename(file) == path.basename(code_map_file) and \
+        file.startswith(path.dirname(code_map_file))
+
+def map_file_of(window):
+    """Every window has its own map file, so the maps of the windows don't share a buffer."""
+    return path.join(path.dirname(code_map_file), 'maps', str(window.id()), path.basename(code_map_file))
 
 def is_code_map_visible():
     map = get_code_map_view()
     if map:
         return map == win().active_view_in_group(get_group(map))
 
-def get_code_map_view():
-    for v in win().views():
-        if v.file_name() == code_map_file:
+def get_code_map_view(window=None):
+    window = window or win()
+    if not window:
+        return None
+
+    state = map_windows.get(window)
+    v = state.map_view
+    if v:
+        v_window = v.window()
+        if v_window and v_window.id() == window.id() and is_code_map(v):
             return v
+        state.map_view, state.searched = None, False    # closed or moved to another window
+
+    if not state.searched:
+        state.searched = True
+        for v in window.views():
+            if is_code_map(v):
+                state.map_view = v
+                return v
 
 # -----------------
 
 
-def reset_globals():
-    global ACTIVE, CURRENT_TEMP_ID, TEMP_VIDS, TEMP_VIEWS
+def reset_globals(window=None):
+    state = map_windows.get(window)
+    state.temp_vids.clear()
+    state.temp_views.clear()
+    state.temp_id = None
+    state.positions.clear()
+    state.active, state.active_view = False, None
+    map_windows.forget(window)
+    state.nav_view, state.navigating, state.skip = None, False, False
 
-    TEMP_VIDS, TEMP_VIEWS, CURRENT_TEMP_ID = [], {}, None
-    ACTIVE = False
-    CodeMapListener.navigating = False
-    CodeMapListener.skip = False
+# -----------------
+
+
+def forget_view(view):
+    """Drops everything kept for the closed view (and for its file if it isn't open elsewhere)."""
+
+    for state in map_windows.states.values():
+        state.temp_vids.discard(view.id())
+        state.temp_views.pop(view.id())
+        state.positions.pop(view.id())
+    Mapper.symbol_table.forget(view.id())
+
+    file = view.file_name()
+    if file and not is_map_file(file) and not any(w.find_open_file(file) for w in sublime.windows()):
+        for state in map_windows.states.values():
+            state.positions.pop(file)
+        Mapper.DEPTH[1].pop(file)
+        Mapper.symbol_table.forget(file)
 
 # -----------------
 
@@ -224,7 +354,7 @@ def reset_layout():
     cols = layout['cols']
     width = 1 - settings().get("codemap_width")
 
-    alone_in_group = len(win().views_in_group(CodeMapListener.map_group)) == 0
+    alone_in_group = len(win().views_in_group(map_windows.get(w).map_group)) == 0
 
     if alone_in_group:
         for i, col in enumerate(cols):
@@ -242,8 +372,9 @@ def reset_layout():
 # -----------------
 
 
-def refresh_map_for(view, from_view=False):
-    global CURRENT_TEMP_ID
+def refresh_map_for(view, from_view=False, on_done=None):
+    """Maps of the physical files are generated on the background worker. `on_done` (e.g. the
+    map synch) is invoked on the main thread once the map is in place."""
 
     # -----------------
 
@@ -259,45 +390,104 @@ def refresh_map_for(view, from_view=False):
 
     # -----------------
 
+    def done():
+        if on_done:
+            on_done()
+
+    # -----------------
+
     def generate_from(file):
-        global Generated_Map
+        using_tabs = Mapper.universal_mapper.state.using_tabs
+        tab_size = Mapper.universal_mapper.state.tab_size
+        trace = Mapper.refresh_stats.begin()
+
+        def generate(cancelled, publish):
+
+            def progress(map, percent):
+                if cancelled():
+                    return False
+                publish(lambda: show(map, percent))
+                return True
+
+            Mapper.universal_mapper.state.using_tabs = using_tabs
+            Mapper.universal_mapper.state.tab_size = tab_size
+            def arrived(result):
+                # the syntaxer has missed the deadline, its map replaces the provisional one
+                (map, symbols) = Mapper.render_map(result)
+                publish(lambda: put((map, py_syntax, symbols)))
+
+            Mapper.universal_mapper.state.progress = progress
+            Mapper.csharp_mapper.local.on_late = arrived
+            Mapper.refresh_stats.resume(trace)
+            try:
+                with Mapper.refresh_stats.stage('cache'):
+                    return map_cache.fetch(view, file, lambda: code_map_generator.map_file(file, view))
+            finally:
+                Mapper.universal_mapper.state.progress = None
+                Mapper.csharp_mapper.local.on_late = None
+                Mapper.refresh_stats.suspend()
+
+        def put(map):
+            global Generated_Map
 
-        map = code_map_generator.get_mapper(file, view)
-        if map:
             Generated_Map = map
             map_view.run_command('code_map_generator', {"source": file})
             clear_map_selection()
+            scroll_left(map_view)
+
+        def show(map, percent=None):
+            if map:
+                Mapper.refresh_stats.resume(trace)
+                put(map)
+                Mapper.refresh_stats.suspend()
+
+            if percent is not None:
+                sublime.status_message('CodeMap: mapping... {0}%'.format(percent))
+            else:
+                Mapper.refresh_stats.end(trace, Mapper.refresh_stats.file_type(file), file)
+                done()
+
+        map_worker.submit(w.id(), generate, show)
 
     # -----------------
 
     file = view.file_name()
     map_view = get_code_map_view()
-    CURRENT_TEMP_ID = None
 
     w = sublime.active_window()
+    state = map_windows.get(w)
+    state.temp_id = None
     widget = view.settings().get('is_widget')
     transient = view == w.transient_view_in_group(w.active_group())
     is_in_same_group = get_group(map_view) == get_group(view)
 
     # indentation type for current view
-    Mapper.universal_mapper.Using_tabs = not view.settings().get('translate_tabs_to_spaces')
+    Mapper.universal_mapper.state.using_tabs = not view.settings().get('translate_tabs_to_spaces')
+    Mapper.universal_mapper.state.tab_size = view.settings().get('tab_size')
 
     if not map_view or widget or transient or is_in_same_group:
-        return
-    elif file and path.basename(file) == "Code - Map":
-        return
+        return done()
+    elif is_map_file(file):
+        return done()
     elif file and os.path.isfile(file):
-        generate_from(file)
+        return generate_from(file)
 
     # buffer is bound to a non-existent path, render from view
     # 'or file' here is not a mistake (it's used for files in zipped archives)
-    elif view.id() in TEMP_VIDS or file or from_view:
-        if view.id() not in TEMP_VIDS:
-            TEMP_VIDS.append(view.id())
-        CURRENT_TEMP_ID = view.id()
+    elif view.id() in state.temp_vids or file or from_view:
+        # the map of this view replaces whatever is being generated in the background
+        map_worker.cancel(w.id())
+        state.temp_vids.add(view.id())
+        state.temp_id = view.id()
+        trace = Mapper.refresh_stats.begin()
+        Mapper.refresh_stats.resume(trace)
         map_view.run_command('code_map_generator', {"source": view.id()})
+        Mapper.refresh_stats.suspend()
+        syntax = path.splitext(path.basename(view.settings().get('syntax') or ''))[0]
+        Mapper.refresh_stats.end(trace, syntax or 'view', view.name() or 'view {0}'.format(view.id()))
         clear_map_selection()
     scroll_left(map_view)
+    done()
 
 # -----------------
 
@@ -312,36 +502,33 @@ def synch_map(v, give_back_focus=True):
         map_view = get_code_map_view()
 
         if map_view and map_view.size() > 0:
+            start = time.perf_counter()
             code_view_line, _ = v.rowcol(v.sel()[0].a)
             prev_map_line = None
+            state = map_windows.of(map_view)
 
-            lines = map_view.lines(Region(0, map_view.size()))
-
-            entries = []
-            index = 0
-            for line in lines:
-                link = map_view.substr(line).split(':')[-1]
-
-                try:
-                    entries.append((int(link), line))
-                except:
-                    continue
-
-            entries.sort(key=lambda tup: tup[0])
+            if not state.symbols:
+                # the map has been restored with the session, index its content once
+                map = map_view.substr(Region(0, map_view.size()))
+                code_map_generator.index(state, map, Mapper.parse_map(map))
 
-            for member_line_num, line in entries:
-                # added +1 so that it works for the first line of the function
-                if member_line_num > code_view_line + 1:
-                    break
-                else:
-                    prev_map_line = line
+            # added +1 so that it works for the first line of the function
+            lines, regions = state.index_lines, state.index_regions
+            i = bisect_right(lines, code_view_line + 1) - 1
+            if i >= 0:
+                prev_map_line = Region(*regions[i])
 
             map_view.sel().clear()
+            state.entry = i if prev_map_line else -1    # see caret_follower
             if prev_map_line:
                 map_view.sel().add(prev_map_line)
                 map_view.show(prev_map_line.a)
                 map_view.window().focus_view(map_view)
 
+            if v.file_name():
+                Mapper.refresh_stats.record(Mapper.refresh_stats.file_type(v.file_name()), 'synch',
+                                            time.perf_counter() - start)
+
         if give_back_focus:
             win().focus_view(v)
 
@@ -350,23 +537,91 @@ def synch_map(v, give_back_focus=True):
 # -----------------
 
 
+class caret_follower():
+    """Opt-in ("follow_caret" setting) highlighting of the map entry of the symbol under the
+    caret. Selection changes are throttled to one lookup per "follow_caret_delay" ms and the
+    lookup is a bisect in the map index, so typing latency doesn't depend on the file size."""
+
+    enabled, delay = False, 100
+    pending, view = False, None
+
+    # -----------------
+
+    def load():
+        caret_follower.enabled = settings().get('follow_caret', False)
+        caret_follower.delay = settings().get('follow_caret_delay', 100)
+
+    def watch():
+        caret_follower.load()
+        settings().add_on_change('code_map_follow_caret', caret_follower.load)
+
+    def unwatch():
+        settings().clear_on_change('code_map_follow_caret')
+
+    # -----------------
+
+    def schedule(view):
+        # hot path: called on every selection change in every view
+        if caret_follower.pending:
+            return
+        caret_follower.pending = True
+        caret_follower.view = view
+        sublime.set_timeout(caret_follower.follow, caret_follower.delay)
+
+    # -----------------
+
+    def follow():
+        v = caret_follower.view
+        caret_follower.pending, caret_follower.view = False, None
+
+        if not v or not v.sel():
+            return
+
+        state = map_windows.of(v)
+        if not state.active or v != state.active_view:
+            return
+
+        # the map must be showing this view
+        if state.temp_id:
+            if state.temp_id != v.id():
+                return
+        elif not v.file_name() or v.file_name() != state.source:
+            return
+
+        code_view_line = v.rowcol(v.sel()[0].b)[0]
+        entry = bisect_right(state.index_lines, code_view_line + 1) - 1
+        if entry == state.entry or entry < 0:
+            return  # still in the same symbol
+
+        map_view = get_code_map_view(v.window())
+        if map_view:
+            state.entry = entry
+            region = Region(*state.index_regions[entry])
+            map_view.sel().clear()
+            map_view.sel().add(region)
+            map_view.show(region.a)
+
+# -----------------
+
+
 def focus_source_code():
-    if CodeMapListener.active_view:
+    active_view = map_windows.get().active_view
+    if active_view:
         w = win()
-        w.focus_view(CodeMapListener.active_view)
+        w.focus_view(active_view)
 
 # -----------------
 
-def get_last_session_map_source():
+def get_last_session_map_source(map_view):
     try:
-        with open(code_map_file+'.source', "r") as file:
+        with open(map_view.file_name()+'.source', "r") as file:
              return file.read()
     except:
         return None
 
-def set_last_session_map_source(source):
+def set_last_session_map_source(map_view, source):
     try:
-        with open(code_map_file+'.source', "w") as file:
+        with open(map_view.file_name()+'.source', "w") as file:
              file.write(source if source else "")
     except:
         pass
@@ -383,35 +638,39 @@ def scroll_left(v):
 
 
 def navigate_to_line(map_view, give_back_focus=False):
+    state = map_windows.of(map_view)
     try:
         point = map_view.sel()[0].a
     except:
         # no idea why this happens, it's a workaround
         point = 0
-        CodeMapListener.skip = True
+        state.skip = True
         win().focus_view(map_view)
 
-    line_region = map_view.line(point)
-    line_text = map_view.substr(line_region)
-    line_num = 1
-    try:
-        line_num = int(line_text.split(':')[-1].strip().split(' ')[-1])
-    except:
+    state.entry = -1    # the map selection is the clicked row, see caret_follower
+    if not state.symbols and map_view.size() > 0:
+        # the map has been restored with the session, index its content once
+        map = map_view.substr(Region(0, map_view.size()))
+        code_map_generator.index(state, map, Mapper.parse_map(map))
+
+    symbol = state.rows.get(map_view.rowcol(point)[0])
+    if not symbol:
         # navigate only if a valid map node is clicked or has caret
         return
+    line_num = symbol.line
 
-    if CURRENT_TEMP_ID:
-        source_code_view = TEMP_VIEWS[CURRENT_TEMP_ID]
+    if state.temp_id:
+        source_code_view = state.temp_views.get(state.temp_id)
     else:
         source_code_view = None
 
-        if not code_map_generator.source:
-            code_map_generator.source = get_last_session_map_source()
+        if not state.source:
+            state.source = get_last_session_map_source(map_view)
 
-        if code_map_generator.source:
-            source_code_view = win().find_open_file(code_map_generator.source)
+        if state.source:
+            source_code_view = win().find_open_file(state.source)
             if not source_code_view:
-                source_code_view = win().open_file(code_map_generator.source)
+                source_code_view = win().open_file(state.source)
 
 
     if source_code_view:
@@ -473,12 +732,70 @@ class code_map_marshaler(sublime_plugin.WindowCommand):
 # =============================================================================
 
 
-class code_map_generator(sublime_plugin.TextCommand):
+class custom_mappers():
+    """Registry of the custom mapper modules (User/CodeMap/custom_mappers/<extension>.py).
+
+    A mapper script is loaded the first time a file with its extension is mapped and reloaded
+    only when the script is modified. The folder is listed again only when its mtime changes."""
+
+    modules = {}            # extension -> (module, script mtime)
+    extensions = set()      # extensions of the available mapper scripts
+    folder_mtime = None
 
     # -----------------
 
-    source = None
-    positions = {}
+    def folder():
+        return path.join(sublime.packages_path(), 'User', 'CodeMap', 'custom_mappers')
+
+    def refresh():
+        try:
+            mtime = os.stat(custom_mappers.folder()).st_mtime
+        except OSError:
+            mtime = None
+
+        if mtime != custom_mappers.folder_mtime:
+            custom_mappers.folder_mtime = mtime
+            scripts = os.listdir(custom_mappers.folder()) if mtime else []
+            custom_mappers.extensions = set(script[:-3] for script in scripts if script.endswith('.py'))
+
+    # -----------------
+
+    def get(extension):
+        """Returns the mapper module for the extension or None."""
+
+        custom_mappers.refresh()
+        if extension not in custom_mappers.extensions:
+            custom_mappers.modules.pop(extension, None)
+            return None
+
+        script = mapper_path(extension)
+        try:
+            mtime = os.stat(script).st_mtime
+        except OSError:
+            return None
+
+        module, loaded_mtime = custom_mappers.modules.get(extension, (None, None))
+        if loaded_mtime != mtime:
+            try:
+                module = SourceFileLoader(extension + "_mapper", script).load_module()
+                if hasattr(module, 'line_reader'):
+                    module.line_reader = Mapper.read_lines
+                if hasattr(module, 'map_depth'):
+                    module.map_depth = Mapper.map_depth
+            except Exception as e:
+                # reported once, the script is not loaded again until it is modified
+                print('CodeMap: cannot load custom mapper', script, e)
+                module = None
+            custom_mappers.modules[extension] = (module, mtime)
+
+        return module
+
+# =============================================================================
+
+
+class code_map_generator(sublime_plugin.TextCommand):
+    """Renders the map of the source into the map view. What the map shows (its source, records
+    and index) is kept in the window_state of the map view window."""
 
     # -----------------
 
@@ -509,15 +826,11 @@ class code_map_generator(sublime_plugin.TextCommand):
                     return mapper
 
                 # try with mappers defined in files next
-                script = extension+'.py'
+                mapper = custom_mappers.get(extension)
 
-                # print('trying to get...', script)
-
-                if script in CUSTOM_MAPPERS:
+                if mapper:
 
                     using_universal_mapper = False
-                    script = mapper_path(extension)
-                    mapper = SourceFileLoader(extension + "_mapper", script).load_module()
                     syntax = mapper.map_syntax if hasattr(mapper, 'map_syntax') else py_syntax
 
                     return mapper.generate, syntax
@@ -530,6 +843,44 @@ class code_map_generator(sublime_plugin.TextCommand):
 
     # -----------------
 
+    def generate_map(file, view=None):
+        """Returns the (map, map syntax, map records) for the file, running the custom mapper if
+        needed."""
+        return code_map_generator.map_file(file, view)[0]
+
+    def map_file(file, view=None):
+        """Returns the (map, map syntax, map records) for the file (or None) and whether the map
+        is provisional (see Mapper.symbol_list)."""
+
+        with Mapper.refresh_stats.stage('dispatch'):
+            mapper = code_map_generator.get_mapper(file, view)
+        if not mapper:
+            return (None, False)
+
+        if using_universal_mapper:
+            (result, map_syntax) = mapper
+        else:
+            (generate, map_syntax) = mapper
+            try:
+                with Mapper.refresh_stats.stage('mapper'):
+                    result = generate(file)
+            except Exception as e:
+                print('Custom mapper failure:', e)
+                return (None, False)
+
+        with Mapper.refresh_stats.stage('format'):
+            (map, symbols) = Mapper.render_map(result)
+        return ((map, map_syntax, symbols), getattr(result, 'provisional', False))
+
+    # -----------------
+
+    def index(state, map, symbols):
+        state.symbols = symbols
+        state.rows = dict((sym.row, sym) for sym in symbols)
+        state.index_lines, state.index_regions = Mapper.index_map(map, symbols)
+
+    # -----------------
+
     def view_to_map(view):
         """Not a physical file, try to generate map directly from view content."""
 
@@ -539,19 +890,18 @@ class code_map_generator(sublime_plugin.TextCommand):
 
         for i, syntax in enumerate(supported):
             if syntax[0].lower() in file_syntax.lower():
-                Mapper.universal_mapper.mapping = supported[i][0]
+                Mapper.universal_mapper.state.mapping = supported[i][0]
                 break
         else:
-            return ("Could not decode view.", txt_syntax)
+            return ("Could not decode view.", txt_syntax, [])
 
         content = view.substr(Region(0, view.size()))
         # skip Mapper.universal_mapper.evaluate, generate directly from view content
-        mapper = Mapper.universal_mapper.generate(content)
+        mapper = Mapper.universal_mapper.generate(content, view.id())
         if mapper:
-            TEMP_VIEWS[view.id()] = view
-            return (mapper, file_syntax)
+            return Mapper.render_map(mapper) + (file_syntax,)
         else:
-            return ("Could not decode view.", txt_syntax)
+            return ("Could not decode view.", txt_syntax, [])
 
     # -----------------
 
@@ -563,9 +913,10 @@ class code_map_generator(sublime_plugin.TextCommand):
 
         map_view = self.view
         map_view.set_read_only(False)
+        state = map_windows.of(map_view)
 
         # remember old position
-        oldSource = code_map_generator.source
+        oldSource = state.source
         if oldSource:
             selected_line = None
             viewport_position = map_view.text_to_layout(map_view.visible_region().a)[1]
@@ -573,19 +924,20 @@ class code_map_generator(sublime_plugin.TextCommand):
             if len(map_view.sel()) > 0 and map_view.sel()[0]:
                 selected_line = map_view.sel()[0]
 
-            code_map_generator.positions[oldSource] = (viewport_position, selected_line)
+            state.positions.put(oldSource, (viewport_position, selected_line))
 
         # generate new map
         source = args['source']
         map_syntax = py_syntax
-        map = None
+        map, symbols = None, []
         
         try:
             # it's the id of the temporary view
             if type(source) != str:
                 for v in sublime.active_window().views():
                     if v.id() == source:
-                        (map, map_syntax) = code_map_generator.view_to_map(v)
+                        (map, map_syntax, symbols) = code_map_generator.view_to_map(v)
+                        state.temp_views.put(v.id(), v)
 
             else:
                 # use temp map that has been generated, then delete it
@@ -593,33 +945,13 @@ class code_map_generator(sublime_plugin.TextCommand):
                 Generated_Map = None
                 if not map:
                     # probably not necessary but to be sure
-                    map = code_map_generator.get_mapper(source)
+                    map = code_map_generator.generate_map(source)
 
-                """using_universal_mapper variable is set in get_mapper, when
-                it comes back here the script knows already where to go."""
-
-                # refresh map -> get_mapper -> sets variable -> then here
-
-                """This detour seems necessary to me because the variable
-                can't be set here, it can only be set where the file type is
-                being evaluated, but how the result must be processed is
-                defined here."""
-
-                if using_universal_mapper:
-                    (map, map_syntax) = map
-                else:
-                    (generate, map_syntax) = map
-                    try:
-                        map = generate(source)
-                    except Exception as e:
-                        print('Custom mapper failure')
-                        raise e
+                (map, map_syntax, symbols) = map
 
         except Exception as err:
             print('code_map.generate:', err)
 
-        all_text = Region(0, map_view.size())
-
         if map_view == None:
             return
 
@@ -628,25 +960,35 @@ class code_map_generator(sublime_plugin.TextCommand):
         
         map = map.replace('<null>', "...")                
 
-        map_view.replace(edit, all_text, map)
+        # replace only the changed map lines, so the rest of the map keeps its highlighting
+        with Mapper.refresh_stats.stage('replace'):
+            old_map = map_view.substr(Region(0, map_view.size()))
+            for begin, end, text in Mapper.map_changes(old_map, map):
+                map_view.replace(edit, Region(begin, end), text)
+
         map_view.set_scratch(True)
-        code_map_generator.source = source
+        with Mapper.refresh_stats.stage('index'):
+            code_map_generator.index(state, map, symbols)
+        state.entry = -1
+        state.source = source
 
-        set_last_session_map_source(source)
+        if source != oldSource:
+            set_last_session_map_source(map_view, source)
 
-        if code_map_generator.source in code_map_generator.positions.keys():
-            (viewport_position, selection) = code_map_generator.positions[code_map_generator.source]
+            if source in state.positions:
+                (viewport_position, selection) = state.positions.get(source)
 
-            if viewport_position:
-                map_view.sel().clear()
-                map_view.set_viewport_position((0, viewport_position), False)
+                if viewport_position:
+                    map_view.sel().clear()
+                    map_view.set_viewport_position((0, viewport_position), False)
 
-                if selection:
-                    map_view.sel().add(selection)
-                else:
-                    map_view.sel().add(Region(0, 0))
+                    if selection:
+                        map_view.sel().add(selection)
+                    else:
+                        map_view.sel().add(Region(0, 0))
 
-        map_view.assign_syntax(map_syntax)
+        if map_view.settings().get('syntax') != map_syntax:
+            map_view.assign_syntax(map_syntax)
         map_view.set_read_only(True)
 
 # ===============================================================================
@@ -659,15 +1001,17 @@ class code_map_increase_depth(sublime_plugin.TextCommand):
         file = self.view.file_name()
         d = settings().get('depth')
         fD = Mapper.DEPTH[1]
+        depth = fD.get(file)
 
-        if file in fD and fD[file] < 4:
-            fD[file] += 1
+        if depth is not None and depth < 4:
+            depth += 1
         elif d < 4:
-            fD[file] = d + 1
+            depth = d + 1
 
-        win().status_message('  Current CodeMap Depth: %d' % fD[file])
-        refresh_map_for(self.view)
-        synch_map(self.view)
+        if depth is not None:
+            fD.put(file, depth)
+        win().status_message('  Current CodeMap Depth: %d' % fD.get(file, d))
+        refresh_map_for(self.view, on_done=lambda: synch_map(self.view))
 
 # ===============================================================================
 
@@ -679,15 +1023,17 @@ class code_map_decrease_depth(sublime_plugin.TextCommand):
         file = self.view.file_name()
         d = settings().get('depth')
         fD = Mapper.DEPTH[1]
+        depth = fD.get(file)
 
-        if file in fD and fD[file] > 0:
-            fD[file] -= 1
+        if depth is not None and depth > 0:
+            depth -= 1
         elif d > 0:
-            fD[file] = d - 1
+            depth = d - 1
 
-        win().status_message('  Current CodeMap Depth: %d' % fD[file])
-        refresh_map_for(self.view)
-        synch_map(self.view)
+        if depth is not None:
+            fD.put(file, depth)
+        win().status_message('  Current CodeMap Depth: %d' % fD.get(file, d))
+        refresh_map_for(self.view, on_done=lambda: synch_map(self.view))
 
 # ===============================================================================
 
@@ -696,7 +1042,7 @@ class navigate_code_map(sublime_plugin.TextCommand):
 
     def run(self, edit, direction=None, start=False, stop=False, fast=False):
 
-        if not ACTIVE:
+        if not is_active():
             map_view = get_code_map_view()
             if map_view:
                 win().status_message('  CodeMap: Synch the map first.')
@@ -706,12 +1052,14 @@ class navigate_code_map(sublime_plugin.TextCommand):
 
         v = self.view
         cm = get_code_map_view()
-        CodeMapListener.skip = True
+        state = map_windows.of(v)
+        state.skip = True
+        state.entry = -1    # the map selection is moved, see caret_follower
 
         if start:
-            if not CodeMapListener.nav_view or not CodeMapListener.navigating:
-                CodeMapListener.nav_view = v
-                CodeMapListener.navigating = True
+            if not state.nav_view or not state.navigating:
+                state.nav_view = v
+                state.navigating = True
                 synch_map(v, give_back_focus=False)
                 sublime.set_timeout(lambda: navigate_to_line(cm, give_back_focus=False), 10)
             else:
@@ -726,9 +1074,9 @@ class navigate_code_map(sublime_plugin.TextCommand):
             v.window().run_command('drag_select', {"by": "words"})
 
         elif stop:
-            win().focus_view(CodeMapListener.nav_view)
-            CodeMapListener.nav_view = None
-            CodeMapListener.navigating = False
+            win().focus_view(state.nav_view)
+            state.nav_view = None
+            state.navigating = False
 
 # ===============================================================================
 
@@ -739,32 +1087,31 @@ class synch_code_map(sublime_plugin.TextCommand):
     # -----------------
 
     def run(self, edit, from_view=False):
-        global ACTIVE
+        state = map_windows.get()
 
-        if not ACTIVE and get_code_map_view():
-            ACTIVE = True
+        if not state.active and get_code_map_view():
+            state.active = True
 
-        if not ACTIVE:
+        if not state.active:
             return
 
         if self.view != get_code_map_view():
             # ignore view in the map_view group as in this case
             # the source and map cannot be visible at the same time
-            if get_group(self.view) == CodeMapListener.map_group:
+            if get_group(self.view) == state.map_group:
                 # only prepare the views(make visible) for the future synch
                 win().focus_view(get_code_map_view())
-                win().focus_view(CodeMapListener.active_view)
+                win().focus_view(state.active_view)
 
             else:
                 # sync doc -> map
-                refresh_map_for(self.view, from_view)
-                synch_map(self.view)
+                refresh_map_for(self.view, from_view, on_done=lambda: synch_map(self.view))
 
         else:
             # (an alternative approach when the sych is always ->)
             # sync doc <- map
             self.view.run_command("code_map_select_line")
-            f = not CodeMapListener.navigating
+            f = not state.navigating
             navigate_to_line(self.view, give_back_focus=f)
 
 # ===============================================================================
@@ -775,19 +1122,18 @@ class show_code_map(sublime_plugin.TextCommand):
     # -----------------
 
     def run(self, edit):
-        global ACTIVE, CURRENT_TEMP_ID, TEMP_VIDS, TEMP_VIEWS, CUSTOM_MAPPERS
-
         w = win()
         Mapper.block_max_pane(True)
         groups = w.num_groups()
         current_view = self.view
         map_view = get_code_map_view()
+        state = map_windows.get(w)
 
         if map_view:
             # Closing Code Map
 
-            if ACTIVE: 
-                CodeMapListener.active_view = current_view
+            if state.active:
+                state.active_view = current_view
                 g, i = w.get_view_index(map_view)
                 w.run_command("close_by_index", {"group": g, "index": i})
                 focus_source_code()
@@ -796,10 +1142,9 @@ class show_code_map(sublime_plugin.TextCommand):
 
         # opening Code Map
 
-        ACTIVE = True
-        CUSTOM_MAPPERS = os.listdir(path.join(sublime.packages_path(), 'User', 'CodeMap', 'custom_mappers'))
+        state.active = True
 
-        CodeMapListener.active_view = current_view
+        state.active_view = current_view
 
         code_map_group = -1
         last_group = w.num_groups()-1
@@ -816,7 +1161,7 @@ class show_code_map(sublime_plugin.TextCommand):
             if not show_in_new_group:
                 if groups == 1:
                     code_map_group = 1
-                    CodeMapListener.map_group = 1
+                    state.map_group = 1
                     Mapper.set_layout_columns(2)
                     groups = 2
 
@@ -826,16 +1171,19 @@ class show_code_map(sublime_plugin.TextCommand):
 
             else:
                 code_map_group = create_codemap_group()
-                CodeMapListener.map_group = code_map_group
+                state.map_group = code_map_group
 
-        with open(code_map_file, "w") as file:
+        map_file = map_file_of(w)
+        if not path.isdir(path.dirname(map_file)):
+            os.makedirs(path.dirname(map_file))
+        with open(map_file, "w") as file:
             file.write('')
 
         try:
-            map_view = w.open_file(code_map_file, transient)
+            map_view = w.open_file(map_file, transient)
         except Exception as e:
             try:
-                map_view = w.open_file(code_map_file)
+                map_view = w.open_file(map_file)
             except Exception as e1:
                 pass
             pass
@@ -854,6 +1202,7 @@ class show_code_map(sublime_plugin.TextCommand):
         map_view.settings().set("gutter", False)
         map_view.settings().set("draw_white_space", "none")
         w.set_view_index(map_view, code_map_group, 0)
+        map_windows.register(map_view)
         map_view.sel().clear()
 
         sublime.set_timeout_async(lambda: w.run_command("synch_code_map"))
@@ -876,6 +1225,7 @@ class code_map_select_line(sublime_plugin.TextCommand):
 
         point = selection[0].a
         line_region = self.view.line(point)
+        map_windows.of(self.view).entry = -1
         self.view.sel().clear()
         self.view.sel().add(line_region)
         sublime.set_timeout_async(lambda: self.view.sel().add(line_region), 10)
@@ -883,29 +1233,83 @@ class code_map_select_line(sublime_plugin.TextCommand):
 # =============================================================================
 
 
+class code_map_show_stats(sublime_plugin.WindowCommand):
+    """Shows the refresh latency of the map stages per file type in an output panel."""
+
+    def run(self):
+        panel = self.window.create_output_panel('code_map_stats')
+        panel.set_read_only(False)
+        panel.run_command('append', {'characters': Mapper.refresh_stats.report()})
+        panel.set_read_only(True)
+        self.window.run_command('show_panel', {'panel': 'output.code_map_stats'})
+
+# =============================================================================
+
+
+class code_map_goto_project_symbol(sublime_plugin.WindowCommand):
+    """Quick panel of the symbols of all the files in the window folders (see project_index)."""
+
+    def run(self):
+        if not settings().get('project_index'):
+            sublime.status_message('CodeMap: set "project_index" to true in the CodeMap settings to index the project')
+            return
+
+        # the files CodeMap has a mapper for (see code_map_generator.get_mapper)
+        Mapper.mapper_profiles.get_settings_hash()
+        extensions = set(Mapper.mapper_profiles.by_extension) - Mapper.mapper_profiles.exclusions - {''}
+        custom_mappers.refresh()
+        extensions |= custom_mappers.extensions
+
+        project_index.refresh(self.window, extensions, custom_mappers.folder(), self.show)
+
+    def show(self, symbols):
+        if not symbols:
+            sublime.status_message('CodeMap: no symbols found in the project')
+            return
+
+        folders = sorted(self.window.folders(), key=len, reverse=True)
+
+        def relative(file):
+            for folder in folders:
+                if file.startswith(folder + os.sep):
+                    return file[len(folder) + 1:]
+            return file
+
+        items = [[name.strip(), '{0}:{1}'.format(relative(file), line)] for name, kind, file, line in symbols]
+
+        def on_select(index):
+            if index >= 0:
+                name, kind, file, line = symbols[index]
+                self.window.open_file('{0}:{1}'.format(file, line), sublime.ENCODED_POSITION)
+
+        self.window.show_quick_panel(items, on_select)
+
+# =============================================================================
+
+
 class CodeMapListener(sublime_plugin.EventListener):
-    active_view, map_view, map_group = None, None, None
-    closing_code_map, opening_code_map = False, False
-    nav_view, navigating, skip = None, False, False
 
     # -----------------
 
     def on_deactivated(self, view):
+        state = map_windows.of(view)
 
-        if ACTIVE:
-            if CodeMapListener.navigating and not CodeMapListener.skip:
-                CodeMapListener.nav_view = None
-                CodeMapListener.navigating = False
-                CodeMapListener.skip = True
-            elif CodeMapListener.skip:
-                CodeMapListener.skip = False
+        if state.active:
+            if state.navigating and not state.skip:
+                state.nav_view = None
+                state.navigating = False
+                state.skip = True
+            elif state.skip:
+                state.skip = False
 
     # -----------------
 
     def on_load(self, view):
-        global ACTIVE
 
-        if ACTIVE and view.file_name() != code_map_file:
+        if is_code_map(view) and view.window():
+            map_windows.register(view)
+
+        if map_windows.of(view).active and not is_code_map(view):
             refresh_map_for(view)
 
         # CodeMap file has been loaded but it's currently inactive
@@ -916,7 +1320,9 @@ class CodeMapListener(sublime_plugin.EventListener):
 
     def on_close(self, view):
 
-        if ACTIVE and view.file_name() == code_map_file:
+        forget_view(view)
+
+        if is_code_map(view) and is_active():
 
             # Issue #35: Issue + Possible Solution:
             #            Toggling Code Map with show_code_map cmd causes active view / file to close
@@ -936,13 +1342,15 @@ class CodeMapListener(sublime_plugin.EventListener):
 
     def on_post_save_async(self, view):
 
-        if ACTIVE:  # map view is opened
-            refresh_map_for(view)
+        if map_windows.of(view).active:  # map view is opened
+
+            def synch():
+                # synch_map brings map_view into focus so call it only
+                # if it is not hidden behind other views
+                if is_code_map_visible():
+                    synch_map(view)
 
-            # synch_map brings map_view into focus so call it only
-            # if it is not hidden behind other views
-            if is_code_map_visible():
-                synch_map(view)
+            refresh_map_for(view, on_done=synch)
 
         # CodeMap file has been loaded but it's currently inactive
         elif get_code_map_view():
@@ -951,38 +1359,47 @@ class CodeMapListener(sublime_plugin.EventListener):
     # -----------------
 
     def on_activated_async(self, view):
+        state = map_windows.of(view)
 
-        if ACTIVE:
+        if state.active:
 
-            if view == get_code_map_view():
-                CodeMapListener.map_group = win().get_view_index(view)[0]
+            if is_code_map(view):
+                map_windows.register(view)
+                state.map_group = win().get_view_index(view)[0]
                 return
 
             # ignore view in the map_view group as in this case
             # the source and map cannot be visible at the same time
             view_group = win().get_view_index(view)[0]
 
-            if view_group == CodeMapListener.map_group:
+            if view_group == state.map_group:
                 pass
 
-            elif view != CodeMapListener.active_view:
+            elif view != state.active_view:
 
-                CodeMapListener.active_view = view
+                state.active_view = view
                 refresh_map_for(view)
 
     # -----------------
 
+    def on_selection_modified(self, view):
+        if caret_follower.enabled:
+            caret_follower.schedule(view)
+
+    # -----------------
+
     def on_text_command(self, view, command_name, args):
         """Process double-click on code map view."""
 
-        if not ACTIVE:
+        state = map_windows.of(view)
+        if not state.active:
             return
 
         double_click = command_name == 'drag_select' and 'by' in args and args['by'] == 'words'
 
-        if double_click and view.file_name() == code_map_file:
+        if double_click and is_code_map(view):
             code_map_marshaler.invoke(lambda:
-                navigate_to_line(view, give_back_focus = not CodeMapListener.navigating))
+                navigate_to_line(view, give_back_focus = not state.navigating))
             return ("code_map_select_line", None)
 
     # -----------------
@@ -1001,16 +1418,20 @@ class CodeMapListener(sublime_plugin.EventListener):
             "project_manager"
         ]
 
-        if ACTIVE and command_name in reset:
-            reset_globals()
+        if is_active(window) and command_name in reset:
+            reset_globals(window)
 
     # -----------------
 
     def on_query_context(self, view, key, operator, operand, match_all):
 
-        if ACTIVE and CodeMapListener.navigating:
+        if not any(state.navigating for state in map_windows.states.values()):
+            return None     # the usual case, without asking the view for its window
+
+        state = map_windows.of(view)
+        if state.navigating and state.active:
             if key == "code_map_nav":
                 return True
             else:
-                CodeMapListener.navigating = False
+                state.navigating = False
         return None
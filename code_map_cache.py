@@ -0,0 +1,219 @@
+import sublime
+import os
+import hashlib
+import json
+import threading
+from os import path
+from . import code_map_support as Mapper
+
+# ===============================================================================
+
+
+def settings():
+    return sublime.load_settings("CodeMap.sublime-settings")
+
+# ===============================================================================
+
+
+class map_cache():
+    """In-memory LRU cache of the generated maps.
+
+    Maps are stored by the hash of the file content (plus everything else the map depends on:
+    extension, custom mapper script, view syntax, depth, indentation type and settings). The buffer id and change count
+    of the view are remembered as a shortcut to the content hash, so switching back to an unchanged
+    tab (or to a clone of it) neither reads the file nor runs the mapper."""
+
+    maps = None
+    buffers = None
+
+    # -----------------
+
+    def init():
+        max_entries = settings().get('map_cache_entries', 100)
+        max_size = settings().get('map_cache_size_kb', 8192) * 1024
+        map_cache.maps = Mapper.lru_map(max_entries, max_size)
+        map_cache.buffers = Mapper.lru_map(max_entries * 4)
+
+    def clear():
+        map_cache.maps = None
+        map_cache.buffers = None
+
+    # -----------------
+
+    def context(view, file):
+        """Everything except the file content the generated map depends on."""
+        depth = Mapper.DEPTH[1].get(file, settings().get('depth'))
+        using_tabs = not view.settings().get('translate_tabs_to_spaces')
+        return (map_cache.mapper_identity(file), view.settings().get('syntax'), depth, using_tabs,
+                view.settings().get('tab_size'), Mapper.mapper_profiles.generation)
+
+    def mapper_identity(file):
+        """Identifies the mapper the file is going to be mapped with: the extension and the
+        mtime of its custom mapper script, so editing the script invalidates its maps."""
+        extension = path.splitext(file)[1][1:].lower()
+        script = path.join(sublime.packages_path(), 'User', 'CodeMap', 'custom_mappers', extension + '.py')
+        try:
+            return '{0}:{1}'.format(extension, os.stat(script).st_mtime)
+        except OSError:
+            return extension
+
+    def content_hash(file):
+        # read in chunks, so hashing a large file doesn't load it into memory
+        sha = hashlib.sha1()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def size_of(map):
+        # the records are counted roughly, as a fixed size per record plus the name
+        return len(map[0]) + sum(64 + len(sym.name) for sym in map[2])
+
+    def stamp(file):
+        stat = os.stat(file)
+        return (stat.st_mtime, stat.st_size)
+
+    # -----------------
+
+    def fetch(view, file, generate):
+        """Returns the cached (map, syntax, map records) for the file shown in the view, or
+        generates it with `generate()` and caches the result. `generate()` returns the map and
+        whether it is provisional (such maps are not cached)."""
+
+        if map_cache.maps is None:
+            map_cache.init()
+
+        try:
+            context = map_cache.context(view, file)
+            buffer_key = (view.buffer_id(), view.change_count(), context)
+            stamp = map_cache.stamp(file)
+
+            known = map_cache.buffers.get(buffer_key)
+            if known and known[0] == stamp:
+                map = map_cache.maps.get(known[1])
+                if map:
+                    return map
+
+            content_key = (map_cache.content_hash(file), context)
+            map = map_cache.maps.get(content_key)
+            if map:
+                map_cache.buffers.put(buffer_key, (stamp, content_key))
+                return map
+
+            map = disk_map_cache.get(file, stamp, context)
+            if map:
+                map_cache.maps.put(content_key, map, map_cache.size_of(map))
+                map_cache.buffers.put(buffer_key, (stamp, content_key))
+                return map
+
+        except Exception as err:
+            print('CodeMap cache:', err)
+            return generate()[0]
+
+        map, provisional = generate()
+        if map and map[0] and not provisional:
+            map_cache.maps.put(content_key, map, map_cache.size_of(map))
+            map_cache.buffers.put(buffer_key, (stamp, content_key))
+            disk_map_cache.put(file, stamp, context, map)
+        return map
+
+# ===============================================================================
+
+
+class disk_map_cache():
+    """Persistent cache of the generated maps (User/CodeMap/map_cache).
+
+    Every file has its own JSON record, named by the hash of its path, keyed by the file mtime,
+    size, settings hash and the rest of the map context (see map_cache.context). A record is read
+    only when its file is mapped. When the records outgrow `disk_map_cache_size_kb` the least
+    recently written ones are deleted, down to half of the size limit."""
+
+    lock = threading.Lock()
+    size = None     # total size of the records (an estimate, known after the first write)
+
+    # -----------------
+
+    def folder():
+        return path.join(sublime.packages_path(), 'User', 'CodeMap', 'map_cache')
+
+    def record_file(file):
+        return path.join(disk_map_cache.folder(), hashlib.sha1(file.encode('utf-8')).hexdigest() + '.json')
+
+    def max_size():
+        return settings().get('disk_map_cache_size_kb', 20480) * 1024
+
+    # -----------------
+
+    def key(file, stamp, context):
+        settings_hash = Mapper.mapper_profiles.get_settings_hash()
+        # the settings generation is session specific, the hash replaces it
+        return json.dumps([stamp[0], stamp[1], settings_hash, context[:-1]])
+
+    # -----------------
+
+    def get(file, stamp, context):
+        try:
+            with open(disk_map_cache.record_file(file), 'r', encoding='utf8') as f:
+                record = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if record.get('path') == file and record.get('key') == disk_map_cache.key(file, stamp, context):
+            symbols = [Mapper.symbol(*item) for item in record['symbols']]
+            return (record['map'], record['syntax'], symbols)
+
+    # -----------------
+
+    def put(file, stamp, context, map):
+        record = {'path': file, 'key': disk_map_cache.key(file, stamp, context),
+                  'map': map[0], 'syntax': map[1], 'symbols': [sym.to_list() for sym in map[2]]}
+        data = json.dumps(record)
+
+        with disk_map_cache.lock:
+            try:
+                folder = disk_map_cache.folder()
+                if not path.isdir(folder):
+                    os.makedirs(folder)
+                if disk_map_cache.size is None:
+                    disk_map_cache.size = sum(size for name, mtime, size in disk_map_cache.records())
+
+                record_file = disk_map_cache.record_file(file)
+                with open(record_file + '.tmp', 'w', encoding='utf8') as f:
+                    f.write(data)
+                os.replace(record_file + '.tmp', record_file)
+
+                # the size of the replaced record isn't subtracted, the estimate is corrected by the pruning
+                disk_map_cache.size += len(data)
+                if disk_map_cache.size > disk_map_cache.max_size():
+                    disk_map_cache.prune()
+            except Exception as err:
+                print('CodeMap cache:', err)
+
+    # -----------------
+
+    def records():
+        """Returns the (file name, mtime, size) of the records."""
+        folder, records = disk_map_cache.folder(), []
+        for name in os.listdir(folder):
+            if name.endswith('.json'):
+                try:
+                    stat = os.stat(path.join(folder, name))
+                except OSError:
+                    continue
+                records.append((name, stat.st_mtime, stat.st_size))
+        return records
+
+    def prune():
+        """Deletes the least recently written records down to half of the size limit."""
+        records = sorted(disk_map_cache.records(), key=lambda record: record[1], reverse=True)
+        budget, size = disk_map_cache.max_size() // 2, 0
+        for name, mtime, record_size in records:
+            if size + record_size <= budget:
+                size += record_size
+                continue
+            budget = 0      # the older records are deleted too
+            try:
+                os.remove(path.join(disk_map_cache.folder(), name))
+            except OSError:
+                pass
+        disk_map_cache.size = size
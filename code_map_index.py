@@ -0,0 +1,296 @@
+import sublime
+import os
+import json
+import hashlib
+import subprocess
+import threading
+import time
+from collections import deque
+from fnmatch import fnmatch
+from os import path
+from . import code_map_support as Mapper
+
+# ===============================================================================
+
+
+def settings():
+    return sublime.load_settings("CodeMap.sublime-settings")
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 2
+
+# ===============================================================================
+
+
+class project_index():
+    """Opt-in index of the symbols of all the files in the folders of a window ("project_index").
+
+    The files are mapped by a pool of external Python processes running tools/index_project.py
+    with the same mappers and settings as the map, so the plugin host stays responsive and the
+    initial build scales with the cores. The index of every folder set is saved in
+    User/CodeMap/project_index and refreshed incrementally: only the files whose mtime or size
+    changed since they were indexed are mapped again.
+
+    Sample: project_index.refresh(window, extensions, mappers_folder, lambda symbols: show(symbols))
+    """
+
+    version = 1
+    worker = None           # path of index_project.py, set on plugin load
+    depth = 4               # symbols down to the deepest map depth (see code_map_increase_depth)
+
+    lock = threading.Lock()
+    indexes = Mapper.lru_map(4)     # folders key -> {'mappers': ..., 'files': {file: [mtime, size, symbols]}}
+    building = set()                # keys of the indexes being refreshed
+    processes = []                  # running worker processes
+    stopped = False
+
+    # -----------------
+
+    def folder():
+        return path.join(sublime.packages_path(), 'User', 'CodeMap', 'project_index')
+
+    def key(folders):
+        return hashlib.sha1(json.dumps(sorted(folders)).encode('utf-8')).hexdigest()
+
+    def index_file(key):
+        return path.join(project_index.folder(), key + '.json')
+
+    # -----------------
+
+    def config(mappers_folder):
+        """Everything the refresh needs from the settings (read on the main thread)."""
+
+        Mapper.mapper_profiles.get_settings_hash()  # loads the profiles
+        mapper_settings = dict(Mapper.mapper_profiles.mapping_settings)
+        for name in ('large_file_size_kb', 'universal_engine'):
+            mapper_settings[name] = settings().get(name)
+        mapper_settings['depth'] = project_index.depth
+
+        try:
+            scripts = sorted((name, os.stat(path.join(mappers_folder, name)).st_mtime)
+                             for name in os.listdir(mappers_folder) if name.endswith('.py'))
+        except OSError:
+            scripts = []
+
+        return {
+            'mappers': [project_index.version, Mapper.mapper_profiles.get_settings_hash(), scripts],
+            'python': settings().get('project_index_python', 'python3'),
+            'processes': settings().get('project_index_processes', 0) or cpu_count(),
+            'exclude': settings().get('project_index_exclude', []),
+            'max_size': settings().get('project_index_max_file_kb', 1024) * 1024,
+            'request': {'settings': mapper_settings, 'custom_mappers': mappers_folder},
+        }
+
+    # -----------------
+
+    def refresh(window, extensions, mappers_folder, on_done):
+        """Brings the index of the window folders up to date on a background thread, then calls
+        `on_done(symbols)` on the main thread with the (name, kind, file, line) of all the symbols.
+        `extensions` are the extensions of the files to index."""
+
+        folders = window.folders()
+        if not folders:
+            sublime.status_message('CodeMap: there are no folders to index in this window')
+            return
+
+        key = project_index.key(folders)
+        with project_index.lock:
+            if key in project_index.building:
+                sublime.status_message('CodeMap: the project index is being updated')
+                return
+            project_index.building.add(key)
+            project_index.stopped = False
+
+        config = project_index.config(mappers_folder)
+
+        def build():
+            symbols = None
+            try:
+                index = project_index.update(key, folders, set(extensions), config)
+                symbols = project_index.symbols(index)
+            except Exception as err:
+                print('CodeMap index:', err)
+            finally:
+                with project_index.lock:
+                    project_index.building.discard(key)
+
+            if symbols is not None:
+                sublime.set_timeout(lambda: on_done(symbols), 0)
+
+        thread = threading.Thread(target=build, name='CodeMap index')
+        thread.daemon = True
+        thread.start()
+
+    # -----------------
+
+    def update(key, folders, extensions, config):
+        """Returns the index of the folders, mapping the files that changed since it was saved."""
+
+        with project_index.lock:
+            index = project_index.indexes.get(key)
+        if index is None:
+            index = project_index.load(key)
+        if index.get('mappers') != config['mappers']:
+            # the settings or the custom mappers have changed, all the files are mapped again
+            index = {'mappers': config['mappers'], 'files': {}}
+
+        files = index['files']
+        found = project_index.collect(folders, extensions, config)
+
+        removed = [file for file in files if file not in found]
+        for file in removed:
+            del files[file]
+
+        changed = [file for file, stamp in found.items() if files.get(file, [None, None])[:2] != list(stamp)]
+        if changed:
+            for file, symbols in project_index.map_files(changed, config).items():
+                mtime, size = found[file]
+                files[file] = [mtime, size, symbols or []]
+
+        if changed or removed:
+            project_index.save(key, index)
+
+        with project_index.lock:
+            project_index.indexes.put(key, index)
+        return index
+
+    # -----------------
+
+    def collect(folders, extensions, config):
+        """Returns the (mtime, size) of the files to index in the folders."""
+
+        exclude, max_size = config['exclude'], config['max_size']
+        found = {}
+        for folder in folders:
+            for root, dirs, names in os.walk(folder):
+                dirs[:] = [name for name in dirs if not any(fnmatch(name, pattern) for pattern in exclude)]
+                for name in names:
+                    if path.splitext(name)[1][1:].lower() not in extensions:
+                        continue
+                    file = path.join(root, name)
+                    try:
+                        stat = os.stat(file)
+                    except OSError:
+                        continue
+                    if stat.st_size <= max_size:
+                        found[file] = (stat.st_mtime, stat.st_size)
+        return found
+
+    # -----------------
+
+    def map_files(files, config):
+        """Maps the files with the pool of worker processes, returns their symbols by file."""
+
+        count = max(1, min(config['processes'], len(files)))
+        results = {}
+        started = time.time()
+        progress = [time.time()]
+
+        startupinfo = None
+        if os.name == 'nt':
+            # no console windows for the workers
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+        def report():
+            # at most once a second
+            if time.time() - progress[0] > 1:
+                progress[0] = time.time()
+                message = 'CodeMap: indexing {0}/{1} files'.format(len(results), len(files))
+                sublime.set_timeout(lambda: sublime.status_message(message), 0)
+
+        def run(chunk):
+            try:
+                process = subprocess.Popen([config['python'], project_index.worker], stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                           startupinfo=startupinfo)
+            except OSError as err:
+                print('CodeMap index: cannot start "{0}" ("project_index_python"): {1}'.format(config['python'], err))
+                return
+
+            with project_index.lock:
+                project_index.processes.append(process)
+
+            # the last lines of the errors, read along so the worker never blocks on them
+            errors = deque(maxlen=20)
+            reader = threading.Thread(target=lambda: errors.extend(process.stderr))
+            reader.daemon = True
+            reader.start()
+
+            try:
+                request = dict(config['request'], files=chunk)
+                process.stdin.write(json.dumps(request).encode('utf-8'))
+                process.stdin.close()
+
+                for line in process.stdout:
+                    file, symbols = json.loads(line.decode('utf-8'))
+                    with project_index.lock:
+                        results[file] = symbols
+                    report()
+            except (IOError, ValueError) as err:
+                print('CodeMap index:', err)
+            finally:
+                process.wait()
+                reader.join()
+                with project_index.lock:
+                    project_index.processes.remove(process)
+
+            if process.returncode and not project_index.stopped:
+                print('CodeMap index: the worker failed ({0})'.format(process.returncode))
+                print(b''.join(errors).decode('utf-8', 'replace'))
+
+        threads = [threading.Thread(target=run, args=(files[i::count],)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        message = 'CodeMap: indexed {0} files in {1:.1f} s'.format(len(results), time.time() - started)
+        sublime.set_timeout(lambda: sublime.status_message(message), 0)
+        return results
+
+    # -----------------
+
+    def stop():
+        """Terminates the running workers (the files mapped so far are kept)."""
+
+        with project_index.lock:
+            project_index.stopped = True
+            processes = list(project_index.processes)
+        for process in processes:
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+    # -----------------
+
+    def symbols(index):
+        return [(name, kind, file, line)
+                for file, (mtime, size, symbols) in sorted(index['files'].items())
+                for name, kind, line in symbols]
+
+    # -----------------
+
+    def load(key):
+        try:
+            with open(project_index.index_file(key), 'r', encoding='utf8') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save(key, index):
+        index_file = project_index.index_file(key)
+        try:
+            if not path.isdir(project_index.folder()):
+                os.makedirs(project_index.folder())
+            with open(index_file + '.tmp', 'w', encoding='utf8') as f:
+                json.dump(index, f)
+            os.replace(index_file + '.tmp', index_file)
+        except Exception as err:
+            print('CodeMap index:', err)
@@ -3,8 +3,24 @@ import sublime
 import os
 import re
 import socket
+import struct
 from socket import error as socket_error
-import errno
+import time
+import difflib
+import json
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd  # Python 3.3 (Sublime Text 3)
 
 # ===============================================================================
 
@@ -16,6 +32,12 @@ DEPTH = [2, {}]
 def settings():
     return sublime.load_settings("CodeMap.sublime-settings")
 
+
+def map_depth(file):
+    """Returns the map depth of the file, as set with the depth commands. This is the depth
+    CodeMap passes to the custom mappers."""
+    return DEPTH[1].get(file, settings().get('depth'))
+
 # -----------------
 
 
@@ -64,6 +86,358 @@ def block_max_pane(mode):
 # ===============================================================================
 
 
+class lru_map():
+    """Dictionary holding at most `max_entries` items and, if the items are stored with their
+    size, at most `max_size` in total. The least recently used items are evicted first."""
+
+    def __init__(self, max_entries, max_size=0):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value, size=0):
+        self.pop(key)
+        self.items[key] = value
+        if size:
+            self.sizes[key] = size
+            self.size += size
+
+        while self.items and (len(self.items) > self.max_entries or
+                              (self.max_size and self.size > self.max_size)):
+            self.pop(next(iter(self.items)))
+
+    def pop(self, key, default=None):
+        self.size -= self.sizes.pop(key, 0)
+        return self.items.pop(key, default)
+
+    def clear(self):
+        self.items.clear()
+        self.sizes.clear()
+        self.size = 0
+
+# ===============================================================================
+
+
+class refresh_stats():
+    """Latency of the map refresh stages (disk read, mapper dispatch, scanning, formatting, map
+    view update, ...) over the last `window` refreshes of every file type.
+
+    A refresh is timed by a `refresh_trace` made current (`resume`) on the thread doing a part of
+    the work. The stages are timed with `with refresh_stats.stage(name):` and the time of a stage
+    doesn't include the stages nested in it. Stages run without a current trace are not timed."""
+
+    window = 100
+    samples = {}    # {(file type, stage): deque of seconds}
+    local = threading.local()
+
+    # -----------------
+
+    def begin():
+        return refresh_trace()
+
+    def resume(trace):
+        refresh_stats.local.trace = trace
+        refresh_stats.local.stack = []
+
+    def suspend():
+        refresh_stats.local.trace = None
+
+    def end(trace, file_type, name):
+        """Records the stages of the finished refresh and reports it if it was slow."""
+
+        total = sum(trace.stages.values())
+        for stage, seconds in list(trace.stages.items()) + [('total', total)]:
+            refresh_stats.record(file_type, stage, seconds)
+
+        threshold = settings().get('slow_refresh_log_ms', 0)
+        if threshold and total * 1000 >= threshold:
+            print('CodeMap: slow refresh of {0}: {1:.0f} ms ({2})'.format(name, total * 1000, ', '.join(
+                '{0} {1:.0f}'.format(stage, seconds * 1000) for stage, seconds in trace.stages.items())))
+
+    def record(file_type, stage, seconds):
+        key = (file_type, stage)
+        if key not in refresh_stats.samples:
+            refresh_stats.samples[key] = deque(maxlen=refresh_stats.window)
+        refresh_stats.samples[key].append(seconds)
+
+    def file_type(file):
+        return os.path.splitext(file)[1].lower() or os.path.basename(file)
+
+    # -----------------
+
+    class stage():
+
+        def __init__(self, name):
+            self.name = name
+            self.trace = getattr(refresh_stats.local, 'trace', None)
+
+        def __enter__(self):
+            if self.trace:
+                refresh_stats.local.stack.append(0.0)  # time of the nested stages
+                self.start = time.perf_counter()
+
+        def __exit__(self, *args):
+            if self.trace:
+                elapsed = time.perf_counter() - self.start
+                stack = refresh_stats.local.stack
+                nested = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                self.trace.add(self.name, elapsed - nested)
+
+    # -----------------
+
+    def report():
+        """Returns the p50/p95/max (ms) of every stage per file type as text."""
+
+        def percentile(values, p):
+            return values[int(round(p * (len(values) - 1)))]
+
+        lines = ['CodeMap refresh latency, last {0} refreshes per file type (ms)'.format(refresh_stats.window)]
+        file_types = sorted(set(file_type for file_type, stage in refresh_stats.samples))
+        if not file_types:
+            lines.append('\nNo maps refreshed yet.')
+
+        for file_type in file_types:
+            lines.append('\n{0:<12}{1:>8}{2:>10}{3:>10}{4:>10}'.format(file_type, 'count', 'p50', 'p95', 'max'))
+            for (key, stage), samples in sorted(refresh_stats.samples.items(), key=lambda item: item[0][1] == 'total'):
+                if key == file_type:
+                    values = sorted(samples)
+                    lines.append('  {0:<10}{1:>8}{2:>10.1f}{3:>10.1f}{4:>10.1f}'.format(
+                        stage, len(values), percentile(values, 0.5) * 1000,
+                        percentile(values, 0.95) * 1000, values[-1] * 1000))
+
+        return '\n'.join(lines) + '\n'
+
+# -----------------
+
+
+class refresh_trace():
+    """Stage times of a single map refresh (see `refresh_stats`)."""
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+# ===============================================================================
+
+
+class symbol():
+    """Map record of a code element: display name, kind (e.g. 'class', mapper specific), source
+    line (1 based), nesting depth and the index of the parent record (-1 for the top level ones).
+    `row` is the map line the record is rendered at."""
+
+    __slots__ = ('name', 'kind', 'line', 'depth', 'parent', 'row')
+
+    def __init__(self, name, kind, line, depth=0, parent=-1, row=None):
+        self.name = name
+        self.kind = kind
+        self.line = line
+        self.depth = depth
+        self.parent = parent
+        self.row = row
+
+    def to_list(self):
+        return [self.name, self.kind, self.line, self.depth, self.parent, self.row]
+
+# -----------------
+
+
+class symbol_list(list):
+    """Records returned by a mapper, together with the options of rendering them into the map.
+    Records of the `group_kinds` get an empty map line before them. A `provisional` list is a
+    stand-in map (e.g. the C# fallback) that is replaced later, so it is not cached."""
+
+    provisional = False
+
+    def __init__(self, items=(), indent=4, indent_char=' ', line_numbers_before=False,
+                 group_kinds=('group', 'class')):
+        list.__init__(self, items)
+        self.indent = indent
+        self.indent_char = indent_char
+        self.line_numbers_before = line_numbers_before
+        self.group_kinds = group_kinds
+
+# -----------------
+
+
+def to_symbols(items):
+    """Converts the mapper output items, `symbol` records or (name, kind, line[, depth[, parent]])
+    tuples, into `symbol` records. Missing parents are assigned from the depth."""
+
+    symbols, stack = [], []
+    for item in items:
+        sym = item if isinstance(item, symbol) else symbol(*item)
+        if len(symbols) and not isinstance(item, symbol) and len(item) < 5:
+            while stack and symbols[stack[-1]].depth >= sym.depth:
+                stack.pop()
+            sym.parent = stack[-1] if stack else -1
+        stack.append(len(symbols))
+        symbols.append(sym)
+    return symbols
+
+
+def render_symbols(symbols, indent=4, indent_char=' ', line_numbers_before=False, group_kinds=('group', 'class')):
+    """Renders the records into the map text (and sets their `row`). This is the map layout of the
+    universal mapper: names are indented by depth and padded, the source line number is appended
+    after ':' (or written on both sides if `line_numbers_before`)."""
+
+    lines = [('\n' if sym.kind in group_kinds else '') + indent_char * sym.depth * indent + sym.name
+             for sym in symbols]
+
+    if not lines:
+        # empty space so it doesn't return None
+        return " "
+
+    max_length = max(len(line) for line in lines)
+    if max_length > 40:
+        max_length = 40
+
+    Map, row = [], 0
+    for sym, line in zip(symbols, lines):
+        spc = 1 if line[0] == "\n" else 0
+        if spc and Map:
+            row += 1
+        string = line + ' ' * (max_length - len(line)) + ' ' * spc
+        if len(string) < 25:
+            string += ' ' * (25 - len(string))
+        num = str(sym.line)
+        if line_numbers_before:
+            Map.append(num + ':   ' + string + num + '\n')
+        else:
+            Map.append(string + '    :' + num + '\n')
+        sym.row = row
+        row += 1
+
+    Map = ''.join(Map)
+    if Map[0] == '\n':
+        Map = Map[1:]
+
+    return Map
+
+
+def parse_map(map):
+    """Adapter for the mappers returning the map text: returns the records of the map lines that
+    end with the source line number (':<line number>')."""
+
+    symbols, stack, indents = [], [], []
+    for row, line in enumerate(map.split('\n')):
+        try:
+            line_num = int(line.split(':')[-1].strip().split(' ')[-1])
+        except:
+            continue
+
+        name = line.rpartition(':')[0].strip()
+        indent = len(line) - len(line.lstrip())
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        parent = stack[-1][1] if stack else -1
+
+        stack.append((indent, len(symbols)))
+        symbols.append(symbol(name, '', line_num, len(stack) - 1, parent, row))
+
+    return symbols
+
+
+def render_map(result):
+    """Returns the map text and records of a mapper result: the map text (legacy mappers), a
+    `symbol_list` or a list of records/tuples (rendered with the default layout)."""
+
+    if result is None:
+        return ('', [])
+
+    if isinstance(result, str):
+        return (result, parse_map(result))
+
+    symbols = to_symbols(result)
+    options = {}
+    if isinstance(result, symbol_list):
+        options = {'indent': result.indent, 'indent_char': result.indent_char,
+                   'line_numbers_before': result.line_numbers_before, 'group_kinds': result.group_kinds}
+
+    return (render_symbols(symbols, **options), symbols)
+
+
+def index_map(map, symbols):
+    """Returns the source line numbers of the records (sorted) and the matching map line regions
+    as (begin, end) tuples."""
+
+    offsets, offset = [], 0
+    for line in map.split('\n'):
+        offsets.append((offset, offset + len(line)))
+        offset += len(line) + 1
+
+    entries = sorted((sym.line, offsets[sym.row]) for sym in symbols
+                     if sym.row is not None and sym.row < len(offsets))
+    return [entry[0] for entry in entries], [entry[1] for entry in entries]
+
+# -----------------
+
+
+def map_changes(old, new):
+    """Returns the changes turning the map text `old` into `new` as (begin, end, text) tuples of
+    the replaced `old` regions, the last change first so they can be applied one by one.
+    Only the changed line blocks are replaced."""
+
+    if old == new:
+        return []
+
+    def split(text):
+        lines = [line + '\n' for line in text.split('\n')]
+        lines[-1] = lines[-1][:-1]
+        return lines
+
+    old_lines, new_lines = split(old), split(new)
+
+    # unchanged lines at the beginning and the end are cheap to skip
+    head, n = 0, min(len(old_lines), len(new_lines))
+    while head < n and old_lines[head] == new_lines[head]:
+        head += 1
+    tail = 0
+    while tail < n - head and old_lines[-1 - tail] == new_lines[-1 - tail]:
+        tail += 1
+
+    old_block = old_lines[head:len(old_lines) - tail]
+    new_block = new_lines[head:len(new_lines) - tail]
+
+    offsets, offset = [], sum(len(line) for line in old_lines[:head])
+    for line in old_block:
+        offsets.append(offset)
+        offset += len(line)
+    offsets.append(offset)
+
+    if len(old_block) * len(new_block) > 1000000:
+        # too big for the line diff, replace the whole changed block
+        opcodes = [('replace', 0, len(old_block), 0, len(new_block))]
+    else:
+        opcodes = difflib.SequenceMatcher(None, old_block, new_block, autojunk=False).get_opcodes()
+
+    changes = [(offsets[i1], offsets[i2], ''.join(new_block[j1:j2]))
+               for tag, i1, i2, j1, j2 in opcodes if tag != 'equal']
+    changes.reverse()
+    return changes
+
+# ===============================================================================
+
+
 class NavigateCodeMap():
 
     def highlight_line(v):
@@ -129,67 +503,356 @@ class NavigateCodeMap():
 # ===============================================================================
 
 
+# patterns that cannot be joined into one alternation (numbered backreferences, global flags)
+fusion_breakers = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)')
+scoped_flags = re.compile(r'\(\?[aiLmsux-]+[:)]')
+regex_special = set('.^$*+?{}[]()|\\')
+
+
+def literal_prefixes(pattern):
+    """Returns the literal strings one of which every match of the pattern starts with (e.g.
+    ['class ', 'def '] for "^(class |def ).*$") or None if the pattern is not anchored with a
+    literal start."""
+
+    def literal(text, whole):
+        # literal characters at the start of the text; all of the text if `whole`
+        chars, i = [], 0
+        while i < len(text):
+            c = text[i]
+            if c == '\\' and i + 1 < len(text) and not text[i + 1].isalnum():
+                c, step = text[i + 1], 2
+            elif c in regex_special:
+                break
+            else:
+                step = 1
+            if text[i + step:i + step + 1] in ('*', '?', '{'):
+                break  # optional character
+            chars.append(c)
+            i += step
+            if text[i:i + 1] == '+':
+                break
+        if whole and i < len(text):
+            return None
+        return ''.join(chars)
+
+    if not pattern.startswith('^') or scoped_flags.search(pattern):
+        return None
+    pattern = pattern[1:]
+
+    if pattern.startswith('('):
+        body = pattern[3:] if pattern.startswith('(?:') else pattern[1:]
+        if body.startswith('?'):
+            return None  # lookaround or named group
+        end = body.find(')')
+        if end < 0 or '(' in body[:end] or '|' in body[end + 1:] or body[end + 1:end + 2] in ('*', '?', '{'):
+            return None
+        alternatives = [literal(alt, True) for alt in body[:end].split('|')]
+        if not all(alternatives):
+            return None
+        return alternatives
+
+    if '|' in pattern:
+        return None  # alternation of the whole pattern
+    prefix = literal(pattern, False)
+    return [prefix] if prefix else None
+
+# -----------------
+
+
+def buffer_pattern(pattern):
+    """Returns True if every match of the pattern in a (left trimmed) line is also found when the
+    pattern searches the whole content with MULTILINE: no string anchors, no lookbehinds, '^' only
+    at the start and no negative lookaheads that could look past the end of the line."""
+
+    if re.search(r'\\[AZ]|\(\?<[=!]', pattern):
+        return False
+
+    i, in_class = 0, False
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if in_class:
+            if c == ']' and pattern[i - 1] != '[' and pattern[i - 2:i] != '[^':
+                in_class = False
+        elif c == '[':
+            in_class = True
+        elif c == '^' and i > 0:
+            return False
+        elif pattern.startswith('(?!', i):
+            end = pattern.find(')', i)
+            lookahead = pattern[i + 3:end]
+            if (i != 1 or pattern[0] != '^' or end < 0 or
+                    any(s in lookahead for s in ('\\s', '\\S', '\\n', '\\W', '\\D', '[^', '('))):
+                return False
+        i += 1
+
+    return True
+
+# -----------------
+
+
+class mapper_profile():
+    """Compiled form of a mapper section in the settings (e.g. "python" or "universal").
+
+    Everything `universal_mapper.generate` needs from the settings is read and the regex
+    patterns are compiled here, once. Profiles are rebuilt only when CodeMap.sublime-settings
+    changes (see `mapper_profiles.watch`)."""
+
+    def __init__(self, name, config):
+        self.name = name
+        self.syntax = config.get('syntax', 'Packages/Text/Plain text.tmLanguage')
+        self.indent = config.get('indent', 0)
+        self.obligatory_indent = config.get('obligatory indent', False)
+        self.line_numbers_before = config.get('line numbers before', False)
+        self.prefix = config.get('prefix', '')
+        self.suffix = config.get('suffix', '')
+        self.errors = []
+
+        self.empty_line_before = None
+        empty_line_before = config.get('empty line in map before', '')
+        if empty_line_before:
+            self.empty_line_before = self.compile(empty_line_before)
+
+        # [(pattern, strip pattern or None, substitution, apply to previous result)]
+        self.patterns = []
+        for i, pat in enumerate(config.get('regex', [])):
+            try:
+                find, strip, substitution, chained = (list(pat) + ['', '', False])[:4]
+                find = re.compile(find)
+                # an empty strip pattern with empty substitution leaves the string as is
+                strip = re.compile(strip) if strip or substitution else None
+                self.patterns.append((find, strip, substitution, chained))
+            except Exception as err:
+                self.errors.append('regex[{0}] {1}: {2}'.format(i, pat, err))
+
+        self.fused, self.prefixes, self.finder = self.prefilter()
+
+    # -----------------
+
+    def prefilter(self):
+        """Returns the line prefilter: a single regex alternation of the patterns tested against the
+        line itself (not chained) and the tuple of literal prefixes every match has to start with
+        (or None if it cannot be told). A line rejected by the prefilter cannot be a declaration.
+
+        The third item is the same alternation for searching the whole content (MULTILINE, see
+        `universal_mapper.scan_buffer`) or None if the patterns can only be matched line by line."""
+
+        heads, matches = [], []
+        for find, strip, substitution, chained in self.patterns:
+            if chained and matches:
+                # the chained pattern is applied to the previous result as `is_func` does
+                string = matches.pop()
+                r = find.search(string)
+                if r and strip:
+                    string = strip.sub(substitution, string)
+                matches.append(string)
+            else:
+                heads.append(find.pattern)
+                matches.append("")
+
+        if not heads or max(matches) or '' in heads:
+            # either a line matching none of the patterns still produces an item or every line matches
+            return None, None, None
+
+        fused = None
+        if not any(fusion_breakers.search(head) for head in heads):
+            try:
+                fused = re.compile('|'.join('(?P<p{0}>{1})'.format(i, head) for i, head in enumerate(heads)))
+            except Exception:
+                pass  # e.g. the same group name in two patterns
+
+        prefixes = []
+        for head in heads:
+            literals = literal_prefixes(head)
+            if not literals:
+                prefixes = None
+                break
+            prefixes.extend(literals)
+
+        finder = None
+        if fused and all(buffer_pattern(head) for head in heads):
+            # the line is left trimmed before the test, so the leading '^' skips the indent
+            heads = ['^[^\\S\\n]*' + head[1:] if head.startswith('^') else head for head in heads]
+            finder = re.compile('|'.join('(?:{0})'.format(head) for head in heads), re.MULTILINE)
+            if any(re.compile(head).search('') for head in heads):
+                finder = None  # would match on every empty line
+
+        return fused, tuple(prefixes) if prefixes else None, finder
+
+    # -----------------
+
+    def compile(self, pattern):
+        try:
+            return re.compile(pattern)
+        except Exception as err:
+            self.errors.append('{0}: {1}'.format(pattern, err))
+
+# -----------------
+
+
+class mapper_profiles():
+    """Registry of the compiled mapper profiles and of the "syntaxes"/"exclusions" lookups."""
+
+    profiles = None
+    generation = 0
+    settings_hash = None
+    mapping_settings = {}       # the settings the maps depend on (see `settings_hash`)
+    by_extension = {}
+    by_syntax = {}
+    exclusions = set()
+
+    # -----------------
+
+    def load():
+        sets = settings()
+        profiles, by_extension, by_syntax = {}, {}, {}
+
+        names = [m[0] for m in sets.get('syntaxes', [])]
+        # "csharp" is the fallback of the cs-script syntaxer (see `csharp_mapper`)
+        for name in ('universal', 'csharp'):
+            if name not in names:
+                names.append(name)
+
+        mapping_settings = {'syntaxes': sets.get('syntaxes'), 'exclusions': sets.get('exclusions')}
+
+        for name in names:
+            config = sets.get(name)
+            mapping_settings[name] = config
+            if not config:  # wrong config
+                continue
+            profile = mapper_profile(name, config)
+            for error in profile.errors:
+                print('CodeMap: invalid pattern in "{0}" mapper, {1}'.format(name, error))
+            profiles[name] = profile
+
+        for name, ext in sets.get('syntaxes', []):
+            by_extension.setdefault(ext, name)
+            by_syntax.setdefault(name.lower(), name)
+
+        mapper_profiles.exclusions = set(sets.get('exclusions', []))
+        mapper_profiles.by_extension = by_extension
+        mapper_profiles.by_syntax = by_syntax
+        mapper_profiles.profiles = profiles
+        # lets the map caches tell maps generated with the old settings
+        mapper_profiles.generation += 1
+        mapper_profiles.mapping_settings = mapping_settings
+        mapper_profiles.settings_hash = hashlib.sha1(
+            json.dumps(mapping_settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+    # -----------------
+
+    def reset():
+        mapper_profiles.load()
+
+    def watch():
+        settings().add_on_change('code_map_profiles', mapper_profiles.reset)
+
+    def unwatch():
+        settings().clear_on_change('code_map_profiles')
+
+    # -----------------
+
+    def get(name):
+        if mapper_profiles.profiles is None:
+            mapper_profiles.load()
+        return mapper_profiles.profiles.get(name)
+
+    def for_extension(extension):
+        """Returns the mapping name assigned to the extension in "syntaxes" (or None)."""
+        if mapper_profiles.profiles is None:
+            mapper_profiles.load()
+        return mapper_profiles.by_extension.get(extension)
+
+    def for_syntax(syntax):
+        """Returns the mapping name matching the syntax name (e.g. "Python") or None."""
+        if mapper_profiles.profiles is None:
+            mapper_profiles.load()
+        return mapper_profiles.by_syntax.get(syntax.lower())
+
+    def get_settings_hash():
+        """Hash of the settings the maps depend on, it survives the editor restart."""
+        if mapper_profiles.profiles is None:
+            mapper_profiles.load()
+        return mapper_profiles.settings_hash
+
+    def is_excluded(extension):
+        if mapper_profiles.profiles is None:
+            mapper_profiles.load()
+        return extension in mapper_profiles.exclusions
+
+# ===============================================================================
+
+
+class mapping_state(threading.local):
+    """The options of the universal mapper, separate for every thread (the worker maps the files
+    while the main thread maps the views without a file).
+
+    `mapping` is the name of the profile to map with, `using_tabs` and `tab_size` are the
+    indentation settings of the view. `progress((map, map syntax, records), percent)` is an
+    optional callback: if set, full scans that take longer than "map_time_budget_ms" publish the
+    map of the symbols found so far after each time slice. Returning False from the callback
+    cancels the mapping (`generate` returns None then)."""
+
+    mapping = None
+    using_tabs = False
+    tab_size = None
+    progress = None
+
+# -----------------
+
+
 class universal_mapper():
     Guess = None
-    Using_tabs = False
+    state = mapping_state()
 
     def evaluate(file, extension, view=None, universal=False):
         global DEPTH
 
-        sets = settings()
-        if file in DEPTH[1]:
-            DEPTH[0] = DEPTH[1][file]
-        else:
-            DEPTH[0] = sets.get('depth')
+        DEPTH[0] = map_depth(file)
 
         # Before checking the file extension, try to guess from the sysntax associated to the view
         if view:
             syntax = os.path.splitext(os.path.split(view.settings().get('syntax'))[1])[0]
-            mappers = [m[0] for m in sets.get('syntaxes')]
-            for i, m in enumerate(mappers):
-                if m.lower() == syntax.lower():
-                    universal_mapper.mapping = mappers[i]
-                    syntax = sets.get(mappers[i])['syntax']
-                    try:
-                        with open(file, "r", encoding='utf8') as f:
-                            content = f.read()
-                        return (universal_mapper.generate(content), syntax)
-                    except Exception as err:
-                        print(err)
-                        return None
+            mapping = mapper_profiles.for_syntax(syntax)
+            profile = mapper_profiles.get(mapping) if mapping else None
+            if profile:
+                universal_mapper.state.mapping = mapping
+                try:
+                    with refresh_stats.stage('read'):
+                        content = read_content(file)
+                    return (universal_mapper.generate(content, file), profile.syntax)
+                except Exception as err:
+                    print(err)
+                    return None
 
         # last resort
         if universal:
-            universal_mapper.mapping = "universal"
-            syntax = sets.get("universal")['syntax']
-            return (universal_mapper.generate(file), syntax)
-
-        # unsupported file types
-        unsupported = [syn for syn in sets.get('exclusions')]
-
-        # get mappers/extensions defined in the settings
-        mappers = [m[0] for m in sets.get('syntaxes')]
-        exts = [m[1] for m in sets.get('syntaxes')]
+            universal_mapper.state.mapping = "universal"
+            profile = mapper_profiles.get("universal")
+            return (universal_mapper.generate(file), profile.syntax)
 
         # TODO: universal_mapper.Guess
         universal_mapper.Guess = None
 
         # attempt to map a known file type as defined in the settings
-        if extension in unsupported:
+        if mapper_profiles.is_excluded(extension):
             return ("Unsupported file type", "Packages/Text/Plain text.tmLanguage")
 
-        elif extension in exts:
-            map = mappers[exts.index(extension)]
-            universal_mapper.mapping = map
+        mapping = mapper_profiles.for_extension(extension)
+
+        if mapping is not None:
+            universal_mapper.state.mapping = mapping
 
-            mapper = sets.get(map)
-            if not mapper:  # wrong config
+            profile = mapper_profiles.get(mapping)
+            if not profile:  # wrong config
                 return None
 
             try:
-                with open(file, "r", encoding='utf8') as f:
-                    file = f.read()
-                return (universal_mapper.generate(file), mapper['syntax'])
+                with refresh_stats.stage('read'):
+                    content = read_content(file)
+                return (universal_mapper.generate(content, file), profile.syntax)
             except Exception as err:
                 print(err)
                 return None
@@ -200,88 +863,219 @@ class universal_mapper():
 
     # -----------------
 
-    def generate(file):
+    def generate(file, key=None):
+        """Maps the content (`file`) with the current `universal_mapper.state.mapping` profile. If `key`
+        (normally the file path) is given, the symbols are kept in `symbol_table` and only the
+        lines changed since the previous call are scanned again. The content can also be an
+        iterable of lines (large files, see `read_content`), such content is always fully scanned."""
 
-        # -----------------
+        profile = mapper_profiles.get(universal_mapper.state.mapping)
+        tab = "\t" if universal_mapper.state.using_tabs else " "
+
+        on_slice = None
+        if universal_mapper.state.progress:
+            progress = universal_mapper.state.progress
+
+            def on_slice(symbols, percent):
+                map, records = render_map(universal_mapper.render(profile, tab, symbols))
+                return progress((map, profile.syntax, records), percent)
+
+        with refresh_stats.stage('scan'):
+            if key and isinstance(file, str):
+                symbols = symbol_table.update(key, file, profile, tab, on_slice)
+            else:
+                symbol_table.forget(key)
+                symbols = universal_mapper.scan(profile, tab, file, on_slice=on_slice)
+
+            if symbols is None:
+                return None     # cancelled
+
+            return universal_mapper.render(profile, tab, symbols)
+
+    # -----------------
 
-        def is_func(patterns, string):
-
-            # patterns is a collection of regex matching definitions to test a given string against.
-            # Each item (definition) consist of a few regex expressions to identify a syntax declaration
-            # and transform groom the regex match into a presentable item in the code map tree
-            # Sample:
-            #     [
-            # 1.      "^(class |function |export class |interface ).*$", 
-            # 2.      "[(:{].*$",                                        
-            # 3.      "",
-            # 4.      false
-            #      ]
-            # 1. Pattern to detect if the string is a declaration (e.g. a class). It is if it matches the pattern
-            # 2. Replacement pattern to be used against a declaration string
-            # 3. Replacement value to be used against a declaration string
-            # 4. instead of testing string test its last matching+grooming result. Only applicable if multiple 
-            #    patterns are defined. 
-            #    Basically it is like this:
-            #      take the pattern def ind apply it on the string, save the matching result
-            #      take the next pattern and apply it to on the last match from the prev matching
-            #      . . .
-            # Note the line text that is tested with regex is left trimmed before the test. Meaning that if your 
-            # code has line " say_hello():" the text that is tested with regex is "say_hello():"
-
-            def search(string, popped=False):
-                r = pat[0].search(string) 
-                if r:
-                    if pat[1] or pat[2]:
-                        r = pat[1].sub(pat[2], string)
-                    else:
-                        r = r.group(0)
-                elif popped:
+    def is_func(patterns, string):
+
+        # patterns is a collection of compiled regex matching definitions (see mapper_profile)
+        # to test a given string against.
+        # Each item (definition) consist of a few regex expressions to identify a syntax declaration
+        # and transform groom the regex match into a presentable item in the code map tree
+        # Sample:
+        #     [
+        # 1.      "^(class |function |export class |interface ).*$", 
+        # 2.      "[(:{].*$",                                        
+        # 3.      "",
+        # 4.      false
+        #      ]
+        # 1. Pattern to detect if the string is a declaration (e.g. a class). It is if it matches the pattern
+        # 2. Replacement pattern to be used against a declaration string
+        # 3. Replacement value to be used against a declaration string
+        # 4. instead of testing string test its last matching+grooming result. Only applicable if multiple 
+        #    patterns are defined. 
+        #    Basically it is like this:
+        #      take the pattern def ind apply it on the string, save the matching result
+        #      take the next pattern and apply it to on the last match from the prev matching
+        #      . . .
+        # Note the line text that is tested with regex is left trimmed before the test. Meaning that if your 
+        # code has line " say_hello():" the text that is tested with regex is "say_hello():"
+
+        def search(string, popped=False):
+            r = find.search(string)
+            if r:
+                if strip:
+                    r = strip.sub(substitution, string)
+                else:
                     r = string
+            elif popped:
+                r = string
+            else:
+                r = ""
+            return r
+
+        matches = []
+        for find, strip, substitution, chained in patterns:
+            if chained and matches:
+                r = search(matches.pop(), popped=True)
+            else:
+                r = search(string)
+            matches.append(r)
+        match = max(matches) if matches else ""
+        return match
+
+    # -----------------
+
+    def scan(profile, tab, content, line_num=1, offset=0, on_slice=None):
+        """Returns the list of symbols (line number, line offset, indent size, text) found in
+        the content (string or `line_reader`). `line_num` and `offset` are the position of the
+        content in the file.
+
+        `on_slice(symbols, percent)` is called after the first "map_time_budget_ms" of scanning and
+        then after time slices twice as long as the previous one (the partial map is rendered every
+        time, so the total rendering cost stays linear). The scan is cancelled (returns None) if
+        `on_slice` returns False."""
+
+        if isinstance(content, str) and profile.finder:
+            if settings().get('universal_engine', 'auto') != 'lines':
+                return universal_mapper.scan_buffer(profile, tab, content, line_num, offset, on_slice)
+
+        symbols = []
+        is_func = universal_mapper.is_func
+        patterns = profile.patterns
+        lines = content.split('\n') if isinstance(content, str) else content
+
+        if on_slice:
+            budget = settings().get('map_time_budget_ms', 50) / 1000.0
+            deadline = time.time() + budget
+
+        fused, prefixes = profile.fused, profile.prefixes
+
+        for line in lines:
+            if line:
+                code = line.lstrip()
+                if prefixes and not code.startswith(prefixes):
+                    _line = ""
+                elif fused and not fused.search(code):
+                    _line = ""
                 else:
-                    r = ""
-                return r
+                    _line = is_func(patterns, code)
+                if _line:
+                    indent = len(line) - len(line.lstrip(tab))
+                    symbols.append((line_num, offset, indent, _line))
+
+            line_num += 1
+            offset += len(line) + 1
 
-            matches = []
-            for pat in patterns:
-                if pat[3] and matches:
-                    r = search(matches.pop(), popped=True)
+            if on_slice and not line_num & 0xff and time.time() > deadline:
+                if isinstance(content, str):
+                    percent = offset * 100 // (len(content) or 1)
                 else:
-                    r = search(string)
-                matches.append(r)
-            match = max(matches)
-            return match
+                    percent = content.position * 100 // (content.size or 1)
+                if not on_slice(list(symbols), percent):
+                    return None
+                budget *= 2
+                deadline = time.time() + budget
+
+        return symbols
+
+    # -----------------
+
+    def scan_buffer(profile, tab, content, line_num=1, offset=0, on_slice=None):
+        """`scan` of the content string with a single MULTILINE search for the candidate lines
+        (`mapper_profile.finder`) instead of testing every line. Only the candidate lines are
+        tested with `is_func` so the result is the same as scanning line by line."""
+
+        symbols = []
+        is_func = universal_mapper.is_func
+        patterns = profile.patterns
+        search = profile.finder.search
+        size = len(content)
+
+        if on_slice:
+            budget = settings().get('map_time_budget_ms', 50) / 1000.0
+            deadline = time.time() + budget
+
+        pos = 0
+        while pos <= size:
+            match = search(content, pos)
+            if not match:
+                break
+
+            start = match.start()
+            if start > pos and content[start - 1] != '\n':
+                start = content.rfind('\n', pos, start) + 1 or pos
+            end = content.find('\n', start)
+            if end < 0:
+                end = size
+            line_num += content.count('\n', pos, start)
+
+            line = content[start:end]
+            if line:
+                _line = is_func(patterns, line.lstrip())
+                if _line:
+                    indent = len(line) - len(line.lstrip(tab))
+                    symbols.append((line_num, offset + start, indent, _line))
+
+            # the next match has to start on the next line (a match may span lines)
+            pos = end + 1
+            line_num += 1
+
+            if on_slice and time.time() > deadline:
+                if not on_slice(list(symbols), pos * 100 // (size or 1)):
+                    return None
+                budget *= 2
+                deadline = time.time() + budget
+
+        return symbols
+
+    # -----------------
+
+    def render(profile, tab, symbols):
+        """Returns the map records (`symbol_list`) of the scanned symbols within the map depth."""
 
         # -----------------
 
-        def find_indent(line, tab):
-            i = re.match(tab + r"+", line)
-            if i:
-                x, ni = re.subn(tab, "", i.group(0))
-                if universal_mapper.Using_tabs:
-                    ...
-                elif indent_size and ni % indent_size:
-                    # skip incorrect indents
-                    return 0
-            else:
+        def find_indent(ni):
+            if not ni:
                 return 0
-            if ni:
-                indents.append(ni)
-                min_ind = min(indents)
-                return int(ni / min_ind)
-            else:
+            if indent_size and ni % indent_size:
+                # skip incorrect indents
                 return 0
+            return ni // unit
         # -----------------
 
-        def obl_indent(line, indent):
-
-            if oblig_indent:
-                if indent:
-                    return line.lstrip()
-                else:
-                    return ""
-            else:
-                return line.lstrip()
-
+        def indent_unit():
+            # the indentation unit is inferred once for the whole file: the greatest common
+            # divisor of the indents or the view's tab size if it divides them all
+            if universal_mapper.state.using_tabs:
+                return 1
+            unit = 0
+            for ni in set(sym[2] for sym in symbols):
+                if ni and not (indent_size and ni % indent_size):
+                    unit = gcd(unit, ni)
+            tab_size = universal_mapper.state.tab_size
+            if unit and tab_size and not unit % tab_size and not (indent_size and tab_size % indent_size):
+                unit = tab_size
+            return unit or 1
         # -----------------
 
         def prefix():
@@ -305,7 +1099,7 @@ class universal_mapper():
 
         def nl(line):
             if new_line_before and mapping != "universal":
-                nl = re.match(new_line_before, line)
+                nl = new_line_before.match(line)
             elif guess == "python" and line.lstrip()[:5] == "class":
                 nl = True
             else:
@@ -315,94 +1109,446 @@ class universal_mapper():
             return nl
         # -----------------
 
-        Map, indents = '', []
-        line_num, printed_lines = 0, []
-        lines = file.split('\n')
+        mapping, guess = profile.name, universal_mapper.Guess
 
-        mapping, guess = universal_mapper.mapping, universal_mapper.Guess
-
-        if universal_mapper.Using_tabs:
-            tab, indent_size = "\t", 1
+        if universal_mapper.state.using_tabs:
+            indent_size = 1
         else:
-            tab, indent_size = " ", settings().get(mapping)['indent']
-
-        oblig_indent = settings().get(mapping)['obligatory indent']
-        new_line_before = settings().get(mapping)['empty line in map before']
-        npos = settings().get(mapping)['line numbers before']
-        pre = settings().get(mapping)['prefix']
-        suf = settings().get(mapping)['suffix']
-        patterns = settings().get(mapping)['regex']
-        for pat in patterns:
-            pat[0] = re.compile(pat[0])
-            pat[1] = re.compile(pat[1])
+            indent_size = profile.indent
 
-        for line in lines:
-            line_num += + 1
+        unit = indent_unit()
 
-            if len(line) == 0:
-                continue
+        new_line_before = profile.empty_line_before
+        pre = profile.prefix
+        suf = profile.suffix
 
-            _line = is_func(patterns, line.lstrip())
-            # _line = is_func(patterns, line)
-            if not _line:
-                continue
-            indent = find_indent(line, tab)
-            line = obl_indent(line, indent)
+        records = symbol_list(indent=indent_size, indent_char=tab,
+                              line_numbers_before=profile.line_numbers_before, group_kinds=('group',))
+        parents = []
+
+        # "obligatory indent" has never affected the map text, only `_line` is rendered
+
+        for line_num, offset, ni, _line in symbols:
+            indent = find_indent(ni)
 
             if indent <= DEPTH[0]:
-                line = nl(_line) + tab * indent * indent_size + prefix() + _line + suffix()
-                printed_lines.append((line, line_num))
-
-        if not printed_lines:
-            # empty space so it doesn't return None
-            return " "
-
-        max_length = max(len(line[0]) for line in printed_lines)
-        if max_length > 40:
-            max_length = 40
-        for line in printed_lines:
-            if len(line) > max_length:
-                line = line[0:max_length - 2] + '...'
-            spc = 1 if line[0][0] == "\n" else 0
-            string = line[0] + ' ' * (max_length - len(line[0])) + ' ' * spc
-            if len(string) < 25:
-                string += ' ' * (25 - len(string))
-            if npos:
-                num = str(line[1])
-                Map += num + ':   ' + string + num + '\n'
-            else:
-                Map += string + '    :' + str(line[1]) + '\n'
+                while parents and records[parents[-1]].depth >= indent:
+                    parents.pop()
+                kind = 'group' if nl(_line) else 'item'
+                parent = parents[-1] if parents else -1
+                parents.append(len(records))
+                records.append(symbol(prefix() + _line + suffix(), kind, line_num, indent, parent))
+
+        return records
+
+# ===============================================================================
+
+
+def read_content(file):
+    """Returns the file content as a string or, for the files above "large_file_size_kb", as a
+    lazy iterable of its lines (see `line_reader`)."""
+
+    if mmap and os.path.getsize(file) > settings().get('large_file_size_kb', 4096) * 1024:
+        return line_reader(file)
+
+    with open(file, "r", encoding='utf8') as f:
+        return f.read()
+
 
-        if Map[0] == '\n':
-            Map = Map[1:]
+def read_lines(file):
+    """Returns the lines of the file, lazily for the files above "large_file_size_kb". This is
+    the line reader CodeMap passes to the custom mappers."""
 
-        return Map
+    content = read_content(file)
+    return content.split('\n') if isinstance(content, str) else iter(content)
+
+# -----------------
+
+
+class line_reader():
+    """Memory-mapped reader of the lines of a (large) file.
+
+    The lines are decoded one at a time, so the memory used doesn't depend on the file size.
+    Iterating the reader yields the lines, `position` is the offset of the last line read."""
+
+    def __init__(self, file):
+        self.file = file
+        self.position = 0
+        self.size = os.path.getsize(file)
+
+    def __iter__(self):
+        return self.lines()
+
+    # -----------------
 
+    def lines(self):
+        """Yields the lines without the line breaks. Like `str.split('\\n')` an empty last line
+        is yielded if the file ends with a line break."""
+
+        with open(self.file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                yield ''
+                return
+
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                pos = 0
+                while True:
+                    end = data.find(b'\n', pos)
+                    self.position = pos
+                    line = data[pos:size if end == -1 else end]
+                    if line.endswith(b'\r'):
+                        line = line[:-1]
+                    yield line.decode('utf8', 'replace')
+
+                    if end == -1:
+                        break
+                    pos = end + 1
+            finally:
+                data.close()
 
 # ===============================================================================
 
+
+def common_prefix_length(a, b):
+    """Length of the common prefix of the strings `a` and `b` (compared block by block)."""
+    n = min(len(a), len(b))
+    i, step = 0, 4096
+    while step:
+        while i + step <= n and a[i:i + step] == b[i:i + step]:
+            i += step
+        step //= 8
+    return i
+
+
+def common_suffix_length(a, b, limit):
+    """Length of the common suffix of the strings `a` and `b`, not longer than `limit`."""
+    la, lb = len(a), len(b)
+    i, step = 0, 4096
+    while step:
+        while i + step <= limit and a[la - i - step:la - i] == b[lb - i - step:lb - i]:
+            i += step
+        step //= 8
+    return i
+
+# -----------------
+
+
+class symbol_table():
+    """Per-file universal mapper symbols, kept between refreshes to allow incremental re-mapping.
+
+    Only the lines changed since the previous refresh (plus the symbol enclosing the change) are
+    scanned again, the symbols after the change are just shifted. The tables of the most recently
+    mapped `max_tables` files are kept."""
+
+    max_tables = 20
+    tables = None
+    lock = threading.Lock()
+
+    def get(key):
+        with symbol_table.lock:
+            if symbol_table.tables is None:
+                symbol_table.tables = lru_map(symbol_table.max_tables)
+            return symbol_table.tables.get(key)
+
+    def update(key, content, profile, tab, on_slice=None):
+        table = symbol_table.get(key)
+
+        if not table or table['profile'] is not profile or table['tab'] != tab:
+            symbols = universal_mapper.scan(profile, tab, content, on_slice=on_slice)
+            if symbols is None:
+                symbol_table.forget(key)
+                return None
+
+        elif table['content'] == content:
+            symbols = table['symbols']
+
+        else:
+            symbols = symbol_table.rescan(table, content, profile, tab)
+
+        with symbol_table.lock:
+            symbol_table.tables.put(key, {'content': content, 'profile': profile, 'tab': tab, 'symbols': symbols})
+        return symbols
+
+    # -----------------
+
+    def forget(key):
+        with symbol_table.lock:
+            if symbol_table.tables is not None:
+                symbol_table.tables.pop(key)
+
+    # -----------------
+
+    def rescan(table, content, profile, tab):
+        old, symbols = table['content'], table['symbols']
+
+        # changed characters: old[start:old_end] -> content[start:new_end]
+        start = common_prefix_length(old, content)
+        tail = common_suffix_length(old, content, min(len(old), len(content)) - start)
+        old_end, new_end = len(old) - tail, len(content) - tail
+
+        # changed lines (0 based): first..last_old -> first..last_new
+        first = old.count('\n', 0, start)
+        last_old = first + old.count('\n', start, old_end)
+        last_new = first + content.count('\n', start, new_end)
+        line_shift, offset_shift = last_new - last_old, len(content) - len(old)
+
+        # rescan from the symbol enclosing the change to the end of the last changed line
+        head = [sym for sym in symbols if sym[0] - 1 < first]
+        if head:
+            scan_line, scan_offset = head[-1][0] - 1, head[-1][1]
+            head.pop()
+        else:
+            scan_line, scan_offset = first, content.rfind('\n', 0, start) + 1
+
+        scan_end = content.find('\n', new_end)
+        if scan_end == -1:
+            scan_end = len(content)
+
+        changed = universal_mapper.scan(profile, tab, content[scan_offset:scan_end], scan_line + 1, scan_offset)
+
+        rest = [(line_num + line_shift, offset + offset_shift, indent, text)
+                for line_num, offset, indent, text in symbols if line_num - 1 > last_old]
+
+        return head + changed + rest
+
+
+# ===============================================================================
+
+class syntaxer_connection():
+    """Connection to the cs-script syntaxer ("syntaxer_port" in cs-script.sublime-settings).
+
+    With the default "syntaxer_framing": "close" the syntaxer closes the connection after
+    sending the response, so every request has its own connection and the response is read
+    until it is closed. With "length" the request and the response are prefixed with their
+    size (4 bytes, big endian) and a single connection is kept open and reused.
+
+    A syntaxer that cannot be connected to is not tried again for `backoff` seconds, the delay
+    doubles after every failure (up to `max_backoff`) and is reset by a successful request.
+
+    The lock guards the state only, the requests themselves run concurrently: a request takes the
+    kept connection for its duration, and the requests made meanwhile connect on their own."""
+
+    timeout = 10
+    min_backoff, max_backoff = 0.5, 30
+
+    lock = threading.Lock()
+    sock = None
+    port = None
+    backoff = 0
+    retry_at = 0
+
+    # -----------------
+
+    def request(port, text):
+        """Returns the syntaxer response (string) or None if the syntaxer is not available."""
+
+        cls = syntaxer_connection
+        with cls.lock:
+            if time.time() < cls.retry_at:
+                return None
+
+        data = text.encode('utf-8')
+        try:
+            if settings().get('syntaxer_framing', 'close') == 'length':
+                response = cls.exchange(port, data)
+            else:
+                cls.close()
+                response = cls.send_and_read_all(port, data)
+        except socket_error as err:
+            with cls.lock:
+                if not cls.backoff:
+                    print('CodeMap: cs-script syntaxer (port {0}) is not available: {1}'.format(port, err))
+                cls.backoff = min(cls.backoff * 2, cls.max_backoff) if cls.backoff else cls.min_backoff
+                cls.retry_at = time.time() + cls.backoff
+            return None
+
+        with cls.lock:
+            cls.backoff = 0
+        return response.decode('utf-8', 'replace')
+
+    # -----------------
+
+    def connect(port):
+        sock = socket.create_connection(('localhost', port), syntaxer_connection.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def close():
+        cls = syntaxer_connection
+        with cls.lock:
+            sock, cls.sock, cls.port = cls.sock, None, None
+        cls.discard(sock)
+
+    def discard(sock):
+        if sock:
+            try:
+                sock.close()
+            except socket_error:
+                pass
+
+    def take(port):
+        """Returns the kept connection to the port (or None), it isn't shared while it's in use."""
+        cls = syntaxer_connection
+        with cls.lock:
+            sock, kept_port, cls.sock, cls.port = cls.sock, cls.port, None, None
+        if sock and kept_port != port:
+            cls.discard(sock)
+            sock = None
+        return sock
+
+    def keep(port, sock):
+        cls = syntaxer_connection
+        with cls.lock:
+            if cls.sock is None:
+                cls.sock, cls.port, sock = sock, port, None
+        cls.discard(sock)   # another request has already put its connection back
+
+    # -----------------
+
+    def send_and_read_all(port, data):
+        sock = syntaxer_connection.connect(port)
+        try:
+            sock.sendall(data)
+            chunks = []
+            while True:
+                chunk = sock.recv(64 * 1024)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        finally:
+            sock.close()
+
+    def exchange(port, data):
+        cls = syntaxer_connection
+        sock = cls.take(port)
+        reused = sock is not None
+
+        try:
+            if not reused:
+                sock = cls.connect(port)
+            try:
+                response = cls.send_and_read_frame(sock, data)
+            except socket_error:
+                if not reused:
+                    raise
+                # the kept connection has been closed by the syntaxer (e.g. restarted), connect again
+                cls.discard(sock)
+                sock = cls.connect(port)
+                response = cls.send_and_read_frame(sock, data)
+        except socket_error:
+            cls.discard(sock)
+            raise
+
+        cls.keep(port, sock)
+        return response
+
+    def send_and_read_frame(sock, data):
+        sock.sendall(struct.pack('>I', len(data)) + data)
+        size = struct.unpack('>I', syntaxer_connection.read_exactly(sock, 4))[0]
+        return syntaxer_connection.read_exactly(sock, size)
+
+    def read_exactly(sock, size):
+        chunks, remaining = [], size
+        while remaining:
+            chunk = sock.recv(min(remaining, 64 * 1024))
+            if not chunk:
+                raise ConnectionResetError('connection closed by the syntaxer')
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+# -----------------
+
+
 class csharp_mapper():
+    """C# maps are generated by the cs-script syntaxer. The request runs on its own thread and if
+    the syntaxer doesn't respond within "csharp_timeout_ms" (or isn't available) the map of the
+    "csharp" universal mapping is returned instead. Such a map is `provisional` (see
+    `symbol_list`) and the syntaxer map is passed to the `local.on_late(map)` callback of the
+    calling thread when it arrives. The last syntaxer maps are kept (by file modification time and size), so
+    an unchanged file doesn't wait for the syntaxer again, and while the syntaxer is mapping a file
+    the maps of the same (unchanged) file wait for that request instead of sending another one."""
+
+    lock = threading.Lock()
+    maps = lru_map(20)          # file -> (stamp, syntaxer map)
+    pending = {}                # file -> the request in flight (see `generate`)
+    local = threading.local()   # on_late callback of the calling thread
+
+    # -----------------
+
+    def fallback(file):
+        if not mapper_profiles.get('csharp'):
+            return None
+        DEPTH[0] = map_depth(file)
+        universal_mapper.state.mapping = 'csharp'
+        records = universal_mapper.generate(read_content(file), file)
+        if records is not None:
+            records.provisional = True
+        return records
+
+    # -----------------
 
     def send_syntax_request(file, operation):
-        try:
+        syntaxerPort = sublime.load_settings("cs-script.sublime-settings").get('syntaxer_port')
+        if syntaxerPort == None:
+            return None
 
-            syntaxerPort = sublime.load_settings("cs-script.sublime-settings").get('syntaxer_port')
-            if syntaxerPort == None:
-                return None
-            
-            clientsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            clientsocket.connect(('localhost', syntaxerPort))
-            request = '-client:{0}\n-op:{1}\n-script:{2}'.format(
-                os.getpid(), operation, file)
-            clientsocket.send(request.encode('utf-8'))
-            response = clientsocket.recv(1024 * 5)
-            return response.decode('utf-8')
-        except socket_error as serr:
-            if serr.errno == errno.ECONNREFUSED:
-                print(serr)
+        request = '-client:{0}\n-op:{1}\n-script:{2}'.format(
+            os.getpid(), operation, file)
+        return syntaxer_connection.request(syntaxerPort, request)
 
     # -----------------
 
+    def request_map(file):
+        response = csharp_mapper.send_syntax_request(file, 'codemap')
+        if response is None:
+            return None
+        return response.replace('\r', '')
+
     def generate(file):
-        return csharp_mapper.send_syntax_request(
-            file, 'codemap').replace('\r', '')
+        cls = csharp_mapper
+        stat = os.stat(file)
+        stamp = (stat.st_mtime, stat.st_size)
+
+        with cls.lock:
+            known = cls.maps.get(file)
+            if known and known[0] == stamp:
+                return known[1]
+
+            state = cls.pending.get(file)
+            send = state is None or state['stamp'] != stamp
+            if send:
+                state = cls.pending[file] = {'stamp': stamp, 'map': None, 'on_late': [],
+                                             'arrived': threading.Event()}
+
+        def request():
+            map = cls.request_map(file)
+            with cls.lock:
+                if map:
+                    cls.maps.put(file, (stamp, map))
+                if cls.pending.get(file) is state:
+                    del cls.pending[file]
+                state['map'] = map
+                state['arrived'].set()
+            if map:
+                for on_late in state['on_late']:
+                    on_late(map)
+
+        if send:
+            thread = threading.Thread(target=request, name='CodeMap syntaxer request')
+            thread.daemon = True
+            thread.start()
+        state['arrived'].wait(settings().get('csharp_timeout_ms', 500) / 1000.0)
+
+        on_late = getattr(cls.local, 'on_late', None)
+        with cls.lock:
+            map = state['map']
+            if not state['arrived'].is_set() and on_late:
+                state['on_late'].append(on_late)
+
+        if map:
+            return map
+
+        return cls.fallback(file)
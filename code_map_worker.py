@@ -0,0 +1,97 @@
+import sublime
+import threading
+from collections import OrderedDict
+
+# ===============================================================================
+
+
+class map_worker():
+    """Generates the maps on a dedicated background thread.
+
+    Every window has at most one pending job: submitting a new job replaces the one that hasn't
+    started yet, and the result of a job that has been superseded while running is dropped. Only
+    the result of the latest job is delivered (on the main thread), so cycling quickly through the
+    tabs maps only the tab the user lands on.
+
+    Sample: map_worker.submit(window.id(), lambda cancelled, publish: generate(), lambda map: show(map))
+    """
+
+    condition = threading.Condition()
+    pending = OrderedDict()     # window id -> (token, generate, deliver)
+    latest = {}                 # window id -> token of the latest submitted job
+    token = 0
+    thread = None
+    stopped = False
+
+    # -----------------
+
+    def submit(window_id, generate, deliver):
+        """`generate(cancelled, publish)` runs on the worker thread, `cancelled()` tells if the job
+        has been superseded in the meantime and `publish(action)` runs the action on the main thread
+        unless the job is superseded (e.g. to show a partial result). `deliver(result)` runs on the
+        main thread, with None if `generate` has failed."""
+
+        with map_worker.condition:
+            map_worker.token += 1
+            token = map_worker.token
+            map_worker.latest[window_id] = token
+            map_worker.pending.pop(window_id, None)
+            map_worker.pending[window_id] = (token, generate, deliver)
+            map_worker.stopped = False
+
+            if not map_worker.thread or not map_worker.thread.is_alive():
+                map_worker.thread = threading.Thread(target=map_worker.run, name='CodeMap worker')
+                map_worker.thread.daemon = True
+                map_worker.thread.start()
+
+            map_worker.condition.notify()
+        return token
+
+    # -----------------
+
+    def is_current(window_id, token):
+        return map_worker.latest.get(window_id) == token
+
+    def cancel(window_id):
+        with map_worker.condition:
+            map_worker.pending.pop(window_id, None)
+            map_worker.latest.pop(window_id, None)
+
+    def stop():
+        with map_worker.condition:
+            map_worker.stopped = True
+            map_worker.pending.clear()
+            map_worker.condition.notify()
+
+    # -----------------
+
+    def run():
+        while True:
+            with map_worker.condition:
+                while not map_worker.pending and not map_worker.stopped:
+                    map_worker.condition.wait()
+                if map_worker.stopped:
+                    return
+                window_id, (token, generate, deliver) = map_worker.pending.popitem(last=False)
+
+            map_worker.execute(window_id, token, generate, deliver)
+
+    # -----------------
+
+    def execute(window_id, token, generate, deliver):
+
+        def cancelled():
+            return not map_worker.is_current(window_id, token)
+
+        def publish(action):
+            if not cancelled():
+                sublime.set_timeout(lambda: None if cancelled() else action(), 0)
+
+        try:
+            result = generate(cancelled, publish)
+        except Exception as err:
+            # the failed job is delivered anyway, so its callbacks (e.g. the map synch) still run
+            print('CodeMap worker:', err)
+            result = None
+
+        publish(lambda: deliver(result))
@@ -3,54 +3,139 @@
 # This script defines a mandatory `def generate(file)` and global variable map_syntax:
 # - `def generate(file)`
 #    The routine analyses the file content and produces the 'code map' representing the content structure.
-#    In this case it builds the list of sections (lines that start with `#` character) in the md file.
+#    In this case it builds the list of sections (headings) in the md file: `#` headings and the
+#    underlined (setext) ones, but not the `#` lines in the code blocks. The lines are read one at a
+#    time, so large files are not loaded into memory. The heading level is the map depth.
 #
 # - `map_syntax`
 #    Optional attribute that defines syntax highlight to be used for the code map text
 #
 # The map format: <item title>:<item position in source code>
+# (or, like here, the list of (title, kind, line, depth) items)
 #
 # You may need to restart Sublime Text to reload the mapper
 
-import codecs
+import re
+import sublime
 
 # you can create custom syntaxes for codemap visuals, this is an example
 map_syntax = 'Packages/User/CodeMap/custom_languages/md.sublime-syntax'
 
+# CodeMap sets it to its `map_depth(file)`, the depth changed with the depth commands
+map_depth = None
+
+def depth_of(file):
+    if map_depth:
+        return map_depth(file)
+    return sublime.load_settings('CodeMap.sublime-settings').get('depth', 1)
+
 def generate(file):
     return md_mapper.generate(file)
 
 class md_mapper():
 
-    def generate(file):
-        map = ''
-
-        try:
-
-            with codecs.open(file, "r") as f:
-                lines = f.read().split('\n')
-
-            line_num = 0
-
-            for line in lines:
-                line_num = line_num + 1
-                line = line.lstrip()
+    max_length = 40
 
-                if len(line) == 0:
-                    continue
-
-                if line.startswith("#"):
-                    max = 20
-                    line = line[0:max]+'...'
-                    for i in range(0, (max+3) - len(line)):
-                        line = line + ' '
+    atx_heading = re.compile(r' {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$')
+    setext_underline = re.compile(r' {0,3}(=+|-+)[ \t]*$')
+    fence = re.compile(r' {0,3}(`{3,}|~{3,})')
+    # lines that can't be (the first line of) a setext heading text
+    not_text = re.compile(r' {0,3}(?:[-+*>|]|\d{1,9}[.)](?:\s|$)|<!--)')
 
-                    map = map + line + '    :' + str(line_num)+'\n'
+    # -----------------
+    def generate(file):
+        members = []
 
+        try:
+            # the file is read one (buffered) line at a time
+            with open(file, "r", encoding='utf8', errors='replace') as lines:
+                members = list(md_mapper.headings(lines, depth_of(file)))
         except Exception as err:
-            print (err)
-
-        return map
+            print ('CodeMap-md:', err)
+
+        return members
+
+    # -----------------
+    def headings(lines, max_depth):
+        """Yields the (title, kind, line, depth) of the headings of the lines down to max_depth."""
+
+        fence = None            # the opening fence of the code block the lines are in
+        comment = False         # in an html comment
+        paragraph = None        # (line number, text) of the paragraph the previous line is in
+
+        numbered = enumerate(lines, 1)
+
+        for line_num, line in numbered:
+            if line_num == 1 and line.rstrip() == '---':
+                # front matter
+                for line_num, line in numbered:
+                    if line.rstrip() in ('---', '...'):
+                        break
+                continue
+
+            if fence:
+                if fence[0] in line:
+                    stripped = line.strip()
+                    if stripped.startswith(fence) and not stripped.strip(fence[0]) and not line.startswith('    '):
+                        fence = None
+                continue
+
+            if comment:
+                comment = '-->' not in line
+                continue
+
+            text = line.lstrip()
+            if not text:
+                paragraph = None
+                continue
+
+            indent = len(line) - len(text)
+            if indent and (indent > 3 or '\t' in line[:indent]):
+                # indented code (or the continuation of the paragraph)
+                continue
+
+            first = text[0]
+            if first not in '#`~=-<':
+                if paragraph is None:
+                    paragraph = None if md_mapper.not_text.match(line) else (line_num, text.rstrip())
+                continue
+
+            if first == '#':
+                match = md_mapper.atx_heading.match(line)
+                if match:
+                    paragraph = None
+                    level = len(match.group(1))
+                    if level - 1 <= max_depth:
+                        yield md_mapper.item(level, match.group(2) or '', line_num)
+                    continue
 
+            elif first in '`~':
+                match = md_mapper.fence.match(line)
+                if match and not (first == '`' and '`' in line[match.end():]):
+                    fence = match.group(1)
+                    paragraph = None
+                    continue
 
+            elif first in '=-' and paragraph:
+                if md_mapper.setext_underline.match(line):
+                    level = 1 if first == '=' else 2
+                    if level - 1 <= max_depth:
+                        yield md_mapper.item(level, paragraph[1], paragraph[0])
+                    paragraph = None
+                    continue
 
+            elif first == '<' and text.startswith('<!--'):
+                comment = '-->' not in line
+                paragraph = None
+                continue
+
+            if paragraph is None:
+                paragraph = None if md_mapper.not_text.match(line) else (line_num, text.rstrip())
+
+    # -----------------
+    def item(level, title, line_num):
+        name = '#' * level + ' ' + title.strip()
+        limit = md_mapper.max_length - 4 * (level - 1)    # the map indents the name by the depth
+        if len(name) > limit:
+            name = name[:limit - 3] + '...'
+        return (name, 'heading', line_num, level - 1)
@@ -2,7 +2,9 @@
 # This script defines a mandatory `def generate(file)` and module attribute map_syntax:
 # - `def generate(file)`
 #    The routine analyses the file content and produces the 'code map' representing the content structure.
-#    In this case it builds the list of sections (lines that start with `#` character) in the py file.
+#    In this case it builds the list of the classes and functions (methods) in the py file. The file is
+#    tokenized (`tokenize` module), so declarations in strings are ignored, and after a change only the
+#    modified top-level blocks (statements at the module level, e.g. a class) are tokenized again.
 #
 # - `map_syntax`
 #    Optional attribute that defines syntax highlight to be used for the code map text
@@ -13,9 +15,13 @@
 
 import codecs
 import sublime
+import tokenize
+from array import array
+from collections import OrderedDict
+from itertools import islice
 
 try:
-    installed = sublime.load_settings('Package Control.sublime-settings').get('installed_packages')
+    installed = sublime.load_settings('Package Control.sublime-settings').get('installed_packages', [])
 except:
     installed = []
 
@@ -27,88 +33,225 @@ else:
     # fallback as MagicPython is not installed
     map_syntax = 'Packages/Python/Python.tmLanguage'
 
+# CodeMap sets it to its shared line reader (lazy and memory-mapped for large files)
+line_reader = None
+
+def read_lines(file):
+    if line_reader:
+        return line_reader(file)
+    with codecs.open(file, "r", encoding='utf8') as f:
+        return f.read().split('\n')
+
 def generate(file):
     return python_mapper.generate(file)
 
 class python_mapper():
+
+    # file -> (line hashes, blocks) of the recently mapped files, every block is
+    # [first line index, [(line offset in the block, kind, text, indent)]]
+    # The hashes of the lines (not the lines) are kept to find the changed lines.
+    files = OrderedDict()
+    max_files = 10
+    max_lines = 1000000     # lines of all the files, 8 bytes per line
+
     # -----------------
     def generate(file):
+        # the lines are streamed (read again if needed), they are never all kept in memory
+        try:
+            previous = python_mapper.files.pop(file, None)
+            if previous:
+                hashes = array('q', map(hash, read_lines(file)))
+                blocks = python_mapper.update(file, previous, hashes)
+            else:
+                hashes = array('q')
+                blocks = python_mapper.parse(hashed(read_lines(file), hashes), 0)
 
-        def str_of(count, char):
-            text = ''
-            for i in range(count):
-                text = text + char
-            return text
-
-        # Pasrse
-        item_max_length = 0
+            files = python_mapper.files
+            files[file] = (hashes, blocks)
+            while files and (len(files) > python_mapper.max_files or
+                             sum(len(h) for h, b in files.values()) > python_mapper.max_lines):
+                files.popitem(last=False)
 
-        try:
-            members = []
+            members = [(start + offset + 1, kind, text, indent)
+                       for start, block in blocks for offset, kind, text, indent in block]
 
-            with codecs.open(file, "r", encoding='utf8') as f:
-                lines = f.read().split('\n')
-
-            line_num = 0
-            last_type = ''
-            last_indent = 0
-            for line in lines:
-                line = line.replace('\t', '    ')
-                line_num = line_num + 1
-                code_line = line.lstrip()
-
-                info = None
-                indent_level = len(line) - len(code_line);
-
-                if code_line.startswith('class '):
-                    last_type = 'class'
-                    last_indent = indent_level
-                    info = (line_num,
-                            'class',
-                            line.split('(')[0].split(':')[0].rstrip(),
-                            indent_level)
-
-                elif code_line.startswith('def '):
-                    if last_type == 'def' and indent_level > last_indent:
-                        continue #local def
-                    last_type = 'def'
-                    last_indent = indent_level
-                    info = (line_num,
-                            'def',
-                            line.split('(')[0].rstrip()+'()',
-                            indent_level)
-
-                if info:
-                    length = len(info[2])
-                    if item_max_length < length:
-                        item_max_length = length
-                    members.append(info)
+        except (tokenize.TokenError, SyntaxError):
+            # the file cannot be tokenized (e.g. it's being edited), fall back to the line prefixes
+            members = python_mapper.scan_lines(read_lines(file))
 
         except Exception as err:
             print ('CodeMap-py:', err)
-            members.clear()
+            members = []
+
+        return python_mapper.format(members)
+
+    # -----------------
+    def update(file, previous, hashes):
+        """Returns the blocks of the new file content, only the blocks with changed lines are
+        tokenized again."""
+
+        old_hashes, old_blocks = previous
+        if old_hashes == hashes:
+            return old_blocks
+
+        prefix = common_prefix_length(old_hashes, hashes)
+        suffix = common_suffix_length(old_hashes, hashes, min(len(old_hashes), len(hashes)) - prefix)
+        changed_end = len(old_hashes) - suffix
+        delta = len(hashes) - len(old_hashes)
+
+        # the block before the change is parsed too: the first changed line may continue it
+        first = 0
+        while first + 1 < len(old_blocks) and old_blocks[first + 1][0] < prefix:
+            first += 1
+        last = first
+        while last < len(old_blocks) and old_blocks[last][0] < changed_end:
+            last += 1
+
+        begin = old_blocks[first][0] if old_blocks else 0
+        end = old_blocks[last][0] + delta if last < len(old_blocks) else len(hashes)
+
+        try:
+            blocks = python_mapper.parse(islice(read_lines(file), begin, end), begin)
+        except (tokenize.TokenError, SyntaxError):
+            # e.g. a string or a bracket opened by the change continues after it
+            return python_mapper.parse(read_lines(file), 0)
+
+        return old_blocks[:first] + blocks + [[start + delta, block] for start, block in old_blocks[last:]]
+
+    # -----------------
+    def parse(lines, begin):
+        """Tokenizes the lines (starting with a top-level statement at the line index `begin`)
+        and returns their blocks."""
+
+        source = iter(lines)
+
+        def readline():
+            for line in source:
+                return line + '\n'
+            return ''
 
-        # format
-        map = ''
+        blocks = [[begin, []]]
+        scopes = []             # (indent, kind) of the enclosing declarations
+        depth = 0               # indentation level
+        position = 0            # index of the token in the logical line
+        kind = None             # declaration keyword waiting for the name
+        is_async = False
+
+        for token_type, string, (row, col), _, line in tokenize.generate_tokens(readline):
+            if token_type == tokenize.INDENT:
+                depth += 1
+            elif token_type == tokenize.DEDENT:
+                depth -= 1
+            elif token_type == tokenize.NEWLINE:
+                position, kind, is_async = 0, None, False
+            elif token_type in (tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER):
+                pass
+            else:
+                if position == 0 and depth == 0 and row > 1:
+                    # a top-level statement starts a new block (and ends the enclosing declarations)
+                    blocks.append([begin + row - 1, []])
+                    scopes = []
+
+                if kind and token_type == tokenize.NAME:
+                    physical = line.split('\n')[0].replace('\t', '    ')
+                    indent = len(physical) - len(physical.lstrip())
+
+                    while scopes and scopes[-1][0] >= indent:
+                        scopes.pop()
+                    local = kind == 'def' and bool(scopes) and scopes[-1][1] == 'def'
+                    scopes.append((indent, kind))
+
+                    if not local:
+                        if kind == 'def':
+                            text = ('async def ' if is_async else 'def ') + string + '()'
+                        else:
+                            text = 'class ' + string
+                        start = blocks[-1][0]
+                        blocks[-1][1].append((begin + row - 1 - start, kind, text, indent))
+                    kind = None
+
+                elif position == 0 and string in ('class', 'def'):
+                    kind = string
+                elif position == 0 and string == 'async':
+                    is_async = True
+                elif position == 1 and is_async and string == 'def':
+                    kind = string
+
+                position += 1
+
+        return blocks
+
+    # -----------------
+    def scan_lines(lines):
+        members = []
+        last_type = ''
+        last_indent = 0
+        for line_num, line in enumerate(lines, 1):
+            line = line.replace('\t', '    ')
+            code_line = line.lstrip()
+            indent_level = len(line) - len(code_line)
+
+            if code_line.startswith('class '):
+                last_type = 'class'
+                last_indent = indent_level
+                members.append((line_num, 'class', code_line.split('(')[0].split(':')[0].rstrip(), indent_level))
+
+            elif code_line.startswith('def ') or code_line.startswith('async def '):
+                if last_type == 'def' and indent_level > last_indent:
+                    continue #local def
+                last_type = 'def'
+                last_indent = indent_level
+                members.append((line_num, 'def', code_line.split('(')[0].rstrip()+'()', indent_level))
+
+        return members
+
+    # -----------------
+    def format(members):
+        item_max_length = max([indent + len(text) for line, kind, text, indent in members] or [0])
+
+        map = []
         last_indent = 0
         last_type = ''
-        for line, content_type, content, indent,  in members:
+        for line, content_type, content, indent in members:
             if indent != last_indent:
                 if last_type == 'class' and content_type != 'class':
                     pass
                 else:
-                    map = map+'\n'
+                    map.append('\n')
             else:
                 if content_type == 'class':
-                    map = map+'\n'
-
-            preffix = str_of(indent, ' ')
-            lean_content = content[indent:]
-            suffix = str_of(item_max_length-len(content), ' ')
-            # suffix = ' '
-            # print(item_max_length)
-            map = map + preffix + lean_content + suffix +' :'+str(line) +'\n'
+                    map.append('\n')
+
+            suffix = ' ' * (item_max_length - indent - len(content))
+            map.append(' ' * indent + content + suffix + ' :' + str(line) + '\n')
             last_indent = indent
             last_type = content_type
 
-        return map
\ No newline at end of file
+        return ''.join(map)
+
+# -----------------
+
+def hashed(lines, hashes):
+    # yields the lines, appending their hashes
+    for line in lines:
+        hashes.append(hash(line))
+        yield line
+
+def common_prefix_length(a, b):
+    # compared in chunks, so unchanged lists are compared at the C level
+    i, step = 0, 4096
+    limit = min(len(a), len(b))
+    while step:
+        while i + step <= limit and a[i:i + step] == b[i:i + step]:
+            i += step
+        step //= 8
+    return i
+
+def common_suffix_length(a, b, limit):
+    i, step = 0, 4096
+    la, lb = len(a), len(b)
+    while step:
+        while i + step <= limit and a[la - i - step:la - i] == b[lb - i - step:lb - i]:
+            i += step
+        step //= 8
+    return i
@@ -2,7 +2,11 @@
 # This script defines a mandatory `def generate(file)` and module attribute map_syntax:
 # - `def generate(file)`
 #    The routine analyses the file content and produces the 'code map' representing the content structure.
-#    In this case it builds the list of sections (lines that start with `#` character) in the py file.
+#    In this case it builds the list of the classes, interfaces, functions, methods and arrow functions
+#    assigned to constants (or class fields) in the ts/js file. The file is read in a single pass that
+#    tracks the comments, strings, template strings and braces, so the declarations in the comments,
+#    strings and function bodies are ignored. The pass needs the text around the current position
+#    (e.g. a comment or a string spans lines), so the file is read as one string, not as lines.
 #
 # - `map_syntax`
 #    Optional attribute that defines syntax highlight to be used for the code map text
@@ -11,11 +15,11 @@
 #
 # You may need to restart Sublime Text to reload the mapper
 
-import codecs
+import re
 import sublime
 
 try:
-    installed = sublime.load_settings('Package Control.sublime-settings').get('installed_packages')
+    installed = sublime.load_settings('Package Control.sublime-settings').get('installed_packages', [])
 except:
     installed = []
 
@@ -27,118 +31,360 @@ else:
     # fallback as TypeScript is not installed
     map_syntax = 'Packages/Python/Python.tmLanguage'
 
+def read_text(file):
+    with open(file, "r", encoding='utf8', errors='replace') as f:
+        return f.read()
+
 def generate(file):
     return ts_mapper.generate(file)
 
 class ts_mapper():
+
+    # tokens of the declaration levels (module, namespace and class bodies)
+    token = re.compile(r"""
+        (?P<space>\s+)
+        |(?P<name>[^\W\d][\w$]*|\$[\w$]*)
+        |(?P<arrow>=>)
+        |(?P<punct>[{}();=<>,:*|&?.])
+        |(?P<other>\d[\w$]*|[^\s\w${}();=<>,:*|&?.'"`/]+)
+        """, re.VERBOSE)
+
+    # everything that does not change the brace depth or hide braces (function bodies)
+    plain = re.compile(r'[^{}\'"`/]+')
+    string = re.compile(r"""'(?:\\[\s\S]|[^'\\\n])*'?|"(?:\\[\s\S]|[^"\\\n])*"?""")
+    template = re.compile(r'(?:\\[\s\S]|\$(?!\{)|[^`\\$])*(`|\$\{|$)')
+    regex = re.compile(r'/(?![*/])(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[A-Za-z]*')
+    word_before = re.compile(r'[\w$]+$')
+
+    # after these words a `/` starts a regex literal and not a division
+    regex_after = {'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 'throw',
+                   'case', 'do', 'else', 'yield', 'await'}
+
+    modifiers = {'export', 'default', 'declare', 'abstract', 'async', 'public', 'private', 'protected',
+                 'static', 'readonly', 'override'}
+
+    # a line break does not end the statement after/before these tokens
+    continued_by = {'=', '=>', ',', '(', ':', '|', '&', '<', '.', '?', '*', '+', '-', 'extends', 'implements'} | modifiers
+    continues = {'{', '.', '=>', '=', ':', '?', '|', '&', ')', '>', ',', 'extends', 'implements'}
+
+    # `{` after these tokens is a value or a type, not a body
+    value_after = {'=', ':', '|', '&', '<', ',', '(', '?', 'return'}
+
     # -----------------
     def generate(file):
+        try:
+            members = ts_mapper.parse(read_text(file))
+        except Exception as err:
+            print ('CodeMap-ts:', err)
+            members = []
 
-        def str_of(count, char):
-            text = ''
-            for i in range(count):
-                text = text + char
-            return text
+        return ts_mapper.format(members)
+
+    # -----------------
+    def parse(text):
+        """Returns the (line, kind, text, depth) of the declarations in the text."""
 
-        # Pasrse
-        item_max_length = 0
         members = []
+        stack = []          # kinds of the open braces: 'class' and 'namespace' bodies are declaration levels
+        classes = 0         # open 'class' braces
+        hidden = 0          # open braces of any other kind (bodies, values, template expressions)
 
-        try:
+        head = []           # (value, position) of the tokens of the current statement
+        parens = 0
+        emitted = False     # the statement has been mapped already
+        broken = False      # a line break that may end the statement
+
+        line_num, line_pos = 1, 0
+        pos, end = 0, len(text)
+
+        def add(kind, caption, name_pos):
+            nonlocal line_num, line_pos
+            line_num += text.count('\n', line_pos, name_pos)
+            line_pos = name_pos
+            members.append((line_num, kind, caption, classes))
+
+        while pos < end:
+            char = text[pos]
 
-            with codecs.open(file, "r", encoding='utf8') as f:
-                lines = f.read().split('\n')
-
-            line_num = 0
-            last_type = ''
-            last_indent = 0
-            for line in lines:
-                line = line.replace('\t', '    ')
-                line_num = line_num + 1
-                code_line = line.lstrip()
-
-                info = None
-                indent_level = len(line) - len(code_line);
-
-                def parse_as_class(keyword, line):
-                    if code_line.startswith(keyword+' ') or code_line.startswith('export '+keyword+' ') :
-                        last_type = keyword
-                        last_indent = indent_level
-                        if code_line.startswith('export '+keyword+' '):
-                            line = line.replace('export '+keyword+' ', keyword+' ')
-
-                        display_line = line.rpartition('implements')[0]
-                        if not display_line:
-                            display_line = line.rpartition('{')[0]
-                        if not display_line:
-                            display_line = line.rstrip()
-
-                        # class CSScriptHoverProvider implements HoverProvider {
-                        info = (line_num,
-                                keyword,
-                                display_line.split('(')[0].split(':')[0].rstrip()+' {}', # suffix brackets make it valid TS syntax
-                                indent_level)
-                        return info
-
-                # miss C# here :)
-                # info = parse_as_class('class', line) ??
-                #        parse_as_class('interface', line) ??
-                #        parse_as_class('whatever', line)
-
-                info = parse_as_class('class', line)
-
-                if not info:
-                    info = parse_as_class('interface', line)
-
-                if info:
+            if hidden:
+                match = ts_mapper.plain.match(text, pos)
+                if match:
+                    pos = match.end()
+                    continue
+
+            elif char not in '{}\'"`/':
+                match = ts_mapper.token.match(text, pos)
+                kind = match.lastgroup
+                value = match.group()
+                pos = match.end()
+
+                if kind == 'space':
+                    if '\n' in value and head and not parens and head[-1][0] not in ts_mapper.continued_by:
+                        broken = True
+                    continue
+
+                if broken:
+                    broken = False
+                    if value not in ts_mapper.continues:
+                        head, emitted = [], False
+
+                if value == '(':
+                    parens += 1
+                elif value == ')':
+                    parens = max(parens - 1, 0)
+                elif value == ';' and not parens:
+                    head, emitted = [], False
+                    continue
+                elif kind == 'arrow' and not parens and not emitted:
+                    found = ts_mapper.assigned_function(head, stack[-1] if stack else None)
+                    if found:
+                        add(*found)
+                        emitted = True
+
+                head.append((value, match.start()))
+                continue
+
+            # braces, strings, comments and regex literals (at any level)
+            if char == '{':
+                pos += 1
+                if hidden:
+                    stack.append('body')
+                    hidden += 1
+                    continue
+
+                broken = False
+                if parens or (head and head[-1][0] in ts_mapper.value_after):
+                    stack.append('value')
+                    hidden += 1
+                    continue
+
+                container = stack[-1] if stack else None
+                opened = 'body'
+                if not emitted:
+                    found, opened = ts_mapper.declaration(head, container)
+                    if found:
+                        add(*found)
+
+                stack.append(opened)
+                if opened in ('class', 'namespace'):
+                    classes += opened == 'class'
+                    head, emitted = [], False
+                else:
+                    hidden += 1
+
+            elif char == '}':
+                pos += 1
+                if not stack:
+                    continue
+                opened = stack.pop()
+                if opened in ('class', 'namespace'):
+                    classes -= opened == 'class'
+                else:
+                    hidden -= 1
+
+                if opened == 'template':
+                    pos, expression = ts_mapper.skip_template(text, pos, stack)
+                    hidden += expression
+                elif hidden:
                     pass
+                elif opened == 'value':
+                    head.append(('{}', pos))
+                else:
+                    head, emitted, parens = [], False, 0
 
-                elif code_line.startswith('function ') or code_line.startswith('export function ') :
-                    if last_type == 'function' and indent_level > last_indent:
-                        continue # private class functions
-                    last_type = 'function'
-                    last_indent = indent_level
-                    info = (line_num,
-                            'function',
-                            line.split('(')[0].rstrip()+'()',
-                            indent_level)
-
-                elif code_line.startswith('public '):
-                    last_type = 'public '
-                    last_indent = indent_level
-                    info = (line_num,
-                            'public ',
-                            line.replace('public ', '').split('(')[0].rstrip()+'()',
-                            indent_level)
-
-                if info:
-                    length = len(info[2])
-                    if item_max_length < length:
-                        item_max_length = length
-                    members.append(info)
+            elif char == '`':
+                pos, expression = ts_mapper.skip_template(text, pos + 1, stack)
+                if expression:
+                    hidden += 1
+                elif not hidden:
+                    head.append(('`', pos))
 
-        except Exception as err:
-            print ('CodeMap-py:', err)
-            members.clear()
+            elif char == '/':
+                following = text[pos + 1:pos + 2]
+                if following == '/':
+                    newline = text.find('\n', pos)
+                    pos = end if newline == -1 else newline
+                elif following == '*':
+                    close = text.find('*/', pos + 2)
+                    pos = end if close == -1 else close + 2
+                else:
+                    match = ts_mapper.regex.match(text, pos) if ts_mapper.starts_regex(text, pos) else None
+                    pos = match.end() if match else pos + 1
+                    if not hidden:
+                        head.append(('/', pos))
 
-        # format
-        map = ''
+            else:
+                match = ts_mapper.string.match(text, pos)
+                pos = match.end()
+                if not hidden:
+                    head.append(("''", pos))
+
+        return members
+
+    # -----------------
+    def skip_template(text, pos, stack):
+        """Skips the template string text from pos, returns the position after its end or after
+        the `${` of an embedded expression (pushed to the stack) and whether it was the latter."""
+
+        match = ts_mapper.template.match(text, pos)
+        expression = match.group(1) == '${'
+        if expression:
+            stack.append('template')
+        return match.end(), expression
+
+    # -----------------
+    def starts_regex(text, pos):
+        i = pos - 1
+        while i >= 0 and text[i] in ' \t\r\n':
+            i -= 1
+        if i < 0:
+            return True
+
+        char = text[i]
+        if char in ')]':
+            return False
+        if char.isalnum() or char in '_$':
+            word = ts_mapper.word_before.search(text, max(0, i - 15), i + 1)
+            return bool(word) and word.group() in ts_mapper.regex_after
+        return True
+
+    # -----------------
+    def first_word(head):
+        i = 0
+        while i < len(head) and head[i][0] in ts_mapper.modifiers:
+            i += 1
+        return i
+
+    # -----------------
+    def declaration(head, container):
+        """Returns the member declared by the statement whose body starts with `{` (or None) and
+        the kind of the body."""
+
+        i = ts_mapper.first_word(head)
+        if i >= len(head):
+            return None, 'body'
+
+        word = head[i][0]
+        following = head[i + 1] if i + 1 < len(head) else ('', 0)
+
+        if word == 'class':
+            if not is_name(following[0]) or following[0] in ('extends', 'implements'):
+                return None, 'class'
+            caption = 'class ' + following[0]
+            if i + 3 < len(head) and head[i + 2][0] == 'extends' and is_name(head[i + 3][0]):
+                caption += ' extends ' + head[i + 3][0]
+            return ('class', caption + ' {}', following[1]), 'class'
+
+        if word == 'interface':
+            if is_name(following[0]):
+                return ('interface', 'interface ' + following[0] + ' {}', following[1]), 'body'
+            return None, 'body'
+
+        if word in ('namespace', 'module') and container != 'class':
+            return None, 'namespace'
+
+        if word == 'function':
+            j = i + 1
+            if j < len(head) and head[j][0] == '*':
+                j += 1
+            if j < len(head) and is_name(head[j][0]):
+                return ('function', 'function ' + head[j][0] + '()', head[j][1]), 'body'
+            return None, 'body'
+
+        found = ts_mapper.assigned_function(head, container, 'function')
+        if found:
+            return found, 'body'
+
+        if container == 'class':
+            # name(...) {, get name() {, async *name<T>(...): type {
+            name = None
+            angles = 0
+            for value, position in head[i:]:
+                if value == '(':
+                    break
+                if value == '<':
+                    angles += 1
+                elif value == '>':
+                    angles -= 1
+                elif not angles and is_name(value):
+                    name = (value, position)
+            else:
+                name = None
+            if name:
+                return ('method', name[0] + '()', name[1]), 'body'
+
+        return None, 'body'
+
+    # -----------------
+    def assigned_function(head, container, keyword='('):
+        """Returns the member for `const name = (...) =>` (or `name = ... =>` in a class body), with
+        the keyword `function` for `const name = function`."""
+
+        i = ts_mapper.first_word(head)
+        if container == 'class':
+            kind = 'method'
+        else:
+            kind = 'function'
+            if i >= len(head) or head[i][0] not in ('const', 'let', 'var'):
+                return None
+            i += 1
+
+        if i + 1 >= len(head) or not is_name(head[i][0]) or head[i + 1][0] not in ('=', ':', '?', '!'):
+            return None
+        name = head[i]
+
+        depth = 0
+        for j in range(i + 1, len(head)):
+            value = head[j][0]
+            if value == '(':
+                depth += 1
+            elif value == ')':
+                depth -= 1
+            elif value == '=' and not depth:
+                break
+        else:
+            return None
+
+        j += 1
+        if j < len(head) and head[j][0] == 'async':
+            j += 1
+        if j >= len(head):
+            return None
+
+        value = head[j][0]
+        if keyword == 'function':
+            if value != 'function':
+                return None
+        elif not (value in ('(', '<') or (is_name(value) and j == len(head) - 1)):
+            return None
+
+        if kind == 'method':
+            return (kind, name[0] + '()', name[1])
+        return (kind, head[i - 1][0] + ' ' + name[0] + '()', name[1])
+
+    # -----------------
+    def format(members):
+        item_max_length = max([depth * 4 + len(text) for line, kind, text, depth in members] or [0])
+
+        map = []
         last_indent = 0
         last_type = ''
-        for line, content_type, content, indent in members:
-            extra_line = ''
+        for line, content_type, content, depth in members:
+            indent = depth * 4
             if indent == last_indent:
                 if content_type != last_type:
-                    extra_line = '\n'
+                    map.append('\n')
             elif content_type == 'class' or content_type == 'interface':
-                extra_line = '\n'
+                map.append('\n')
 
-            preffix = str_of(indent, ' ')
-            lean_content = content[indent:]
-            suffix = str_of(item_max_length-len(content), ' ')
-            map = map + extra_line + preffix + lean_content + suffix +' :'+str(line) +'\n'
+            suffix = ' ' * (item_max_length - indent - len(content))
+            map.append(' ' * indent + content + suffix + ' :' + str(line) + '\n')
             last_indent = indent
             last_type = content_type
 
-        # print(map)
-        return map
\ No newline at end of file
+        return ''.join(map)
+
+# -----------------
+
+def is_name(value):
+    return bool(value) and (value[0].isalpha() or value[0] in '_$')
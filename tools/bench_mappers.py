@@ -0,0 +1,262 @@
+# Benchmark of the CodeMap mappers outside of Sublime Text.
+#
+# The mappers are imported with the `sublime` stand-in module from this folder and run on
+# synthetic files of the given sizes (lines). For every mapper and size the throughput (lines/s),
+# peak memory (tracemalloc) and the size of the produced map are reported and can be saved as
+# JSON, so the results of two commits can be compared:
+#
+#   python3 tools/bench_mappers.py --output before.json
+#   git checkout <other commit>
+#   python3 tools/bench_mappers.py --compare before.json
+#
+# Run `python3 tools/bench_mappers.py --help` for all the options.
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from importlib.machinery import SourceFileLoader
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(tools_dir)
+
+sys.path.insert(0, tools_dir)
+sys.path.insert(1, package_dir)
+
+import sublime  # noqa: E402 (the stand-in from tools_dir)
+import code_map_support as Mapper  # noqa: E402
+
+# ===============================================================================
+# Synthetic sources, generated block by block until the requested number of lines is reached.
+
+
+def python_block(rng, n):
+    return [
+        'class Item{0}(Base):'.format(n),
+        '    """Item {0} of the synthetic corpus."""'.format(n),
+        '',
+        '    def __init__(self, value={0}):'.format(rng.randint(0, 100)),
+        '        self.value = value',
+        '',
+        '    def method_{0}(self, a, b):'.format(n),
+        '        # adds the arguments',
+        '        total = a + b + self.value',
+        '        if total > {0}:'.format(rng.randint(0, 100)),
+        '            return total',
+        '        return None',
+        '',
+        '',
+        'def function_{0}(items):'.format(n),
+        '    return [item for item in items if item]',
+        '',
+        '',
+    ]
+
+
+def ts_block(rng, n):
+    return [
+        'export class Item{0} implements Base {{'.format(n),
+        '    private value: number = {0};'.format(rng.randint(0, 100)),
+        '',
+        '    constructor(value: number) {',
+        '        this.value = value;',
+        '    }',
+        '',
+        '    public method{0}(a: number, b: number): number {{'.format(n),
+        '        // adds the arguments',
+        '        const total = a + b + this.value;',
+        '        if (total > {0}) {{'.format(rng.randint(0, 100)),
+        '            return total;',
+        '        }',
+        '        return 0;',
+        '    }',
+        '}',
+        '',
+        'export interface IItem{0} {{'.format(n),
+        '    value: number;',
+        '}',
+        '',
+    ]
+
+
+def md_block(rng, n):
+    return [
+        '# Chapter {0}'.format(n),
+        '',
+        'Text of the chapter {0}, {1} words long.'.format(n, rng.randint(10, 500)),
+        '',
+        '## Section {0}.1'.format(n),
+        '',
+        '```python',
+        '# not a heading',
+        'print({0})'.format(n),
+        '```',
+        '',
+        '### Details',
+        '',
+        '- item one',
+        '- item two',
+        '',
+    ]
+
+
+languages = {
+    'python': ('.py', python_block),
+    'ts': ('.ts', ts_block),
+    'md': ('.md', md_block),
+}
+
+
+def write_corpus(folder, language, size):
+    extension, block = languages[language]
+    file = os.path.join(folder, '{0}_{1}{2}'.format(language, size, extension))
+    rng = random.Random(size)
+    lines, n = [], 0
+    while len(lines) < size:
+        lines.extend(block(rng, n))
+        n += 1
+    with open(file, 'w', encoding='utf8') as f:
+        f.write('\n'.join(lines[:size]))
+    return file
+
+# ===============================================================================
+# Mappers
+
+
+def universal(mapping):
+    def run(file):
+        Mapper.DEPTH[0] = Mapper.settings().get('depth')
+        Mapper.universal_mapper.state.mapping = mapping
+        return Mapper.universal_mapper.generate(Mapper.read_content(file))
+    return run
+
+
+def custom(name):
+    # a fresh module, so the runs don't reuse what a mapper caches between the calls
+    module = SourceFileLoader('bench_' + name, os.path.join(package_dir, 'custom_mappers', name + '.py')).load_module()
+    if hasattr(module, 'line_reader'):
+        module.line_reader = Mapper.read_lines
+
+    def run(file):
+        return module.generate(file)
+    return run
+
+
+# name: (language of the corpus, mapper factory), every run is done with a new mapper
+mappers = {
+    'universal-python': ('python', lambda: universal('python')),
+    'universal-ts': ('ts', lambda: universal('universal')),
+    'python_mapper': ('python', lambda: custom('py')),
+    'ts_mapper': ('ts', lambda: custom('ts')),
+    'md_mapper': ('md', lambda: custom('md')),
+}
+
+# ===============================================================================
+
+
+def measure(factory, file, size, repeat):
+    seconds = None
+    for i in range(repeat):
+        run = factory()
+        start = time.perf_counter()
+        result = run(file)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    run = factory()
+    tracemalloc.start()
+    try:
+        run(file)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    map, records = Mapper.render_map(result)
+
+    return {
+        'lines': size,
+        'bytes': os.path.getsize(file),
+        'seconds': round(seconds, 6),
+        'lines_per_second': int(size / seconds) if seconds else None,
+        'peak_memory_kb': peak // 1024,
+        'map_chars': len(map),
+        'map_records': len(records),
+    }
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=package_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline):
+    before = {(r['mapper'], r['lines']): r for r in baseline['results']}
+    print('\ncompared to {0}:'.format(baseline.get('commit')))
+    for r in results:
+        old = before.get((r['mapper'], r['lines']))
+        if not old or not old['seconds']:
+            continue
+        print('{0:<18} {1:>8}  time x{2:.2f}  memory x{3:.2f}{4}'.format(
+            r['mapper'], r['lines'], r['seconds'] / old['seconds'],
+            r['peak_memory_kb'] / (old['peak_memory_kb'] or 1),
+            '' if r['map_chars'] == old['map_chars'] else '  (map size changed)'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the CodeMap mappers.')
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help='comma separated numbers of lines of the generated files')
+    parser.add_argument('--mappers', default=','.join(sorted(mappers)),
+                        help='comma separated mappers to run: ' + ', '.join(sorted(mappers)))
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best time is reported')
+    parser.add_argument('--engine', help='"universal_engine" setting for the universal mapper')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file of previous results to compare with')
+    args = parser.parse_args()
+
+    if args.engine:
+        sublime.load_settings('CodeMap.sublime-settings').set('universal_engine', args.engine)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        corpora = {}
+        for name in args.mappers.split(','):
+            language, factory = mappers[name]
+            for size in sizes:
+                if (language, size) not in corpora:
+                    corpora[language, size] = write_corpus(folder, language, size)
+                result = measure(factory, corpora[language, size], size, args.repeat)
+                result['mapper'] = name
+                results.append(result)
+                print('{0:<18} {1:>8} lines  {2:>10} lines/s  {3:>8} KB peak  {4:>6} records'.format(
+                    name, size, result['lines_per_second'], result['peak_memory_kb'], result['map_records']))
+
+    report = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'engine': Mapper.settings().get('universal_engine'),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf8') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
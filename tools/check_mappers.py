@@ -0,0 +1,165 @@
+# Consistency check of the incremental CodeMap mappers outside of Sublime Text.
+#
+# py.py tokenizes only the changed top-level blocks of a file it has mapped before. This script
+# edits fixture files (and optionally any given Python files) and checks that after every edit the
+# incremental map is the same as the map of a freshly loaded mapper:
+#
+#   python3 tools/check_mappers.py
+#   python3 tools/check_mappers.py --edits 50 /usr/lib/python3*/*.py
+#
+# Run `python3 tools/check_mappers.py --help` for all the options.
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+from importlib.machinery import SourceFileLoader
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(tools_dir)
+
+sys.path.insert(0, tools_dir)
+sys.path.insert(1, package_dir)
+
+import sublime  # noqa: E402 (the stand-in from tools_dir)
+import code_map_support as Mapper  # noqa: E402
+
+# ===============================================================================
+# Fixtures: [lines, [(line index, new line)]], every edit is applied and checked in turn.
+
+fixtures = {
+    # declarations under top-level compound statements, after a top-level def
+    'def under if': [[
+        'def a(): pass',
+        '',
+        'if X:',
+        '    def b():',
+        '        pass',
+        'else:',
+        '    def c():',
+        '        pass',
+    ], [(4, '        pass # edited'), (0, 'def a(): return 1'), (6, '    def d():')]],
+
+    'def under try': [[
+        'def a():',
+        '    def local():',
+        '        pass',
+        '',
+        'try:',
+        '    def b():',
+        '        pass',
+        'except ImportError:',
+        '    class C:',
+        '        def m(self):',
+        '            pass',
+    ], [(6, '        return None'), (1, '    def local2():'), (10, '            return 1')]],
+
+    'nested and local': [[
+        'class A:',
+        '    def m(self):',
+        '        def local():',
+        '            pass',
+        '        return local',
+        '',
+        '    class B:',
+        '        async def n(self):',
+        '            pass',
+        '',
+        'with open(x) as f:',
+        '    def b():',
+        '        pass',
+    ], [(3, '            return 1'), (12, '        return 2'), (7, '        def n(self):')]],
+
+    'strings': [[
+        'def a():',
+        '    """',
+        '    def not_a_function():',
+        '    """',
+        '',
+        'x = """',
+        'class NotAClass:',
+        '"""',
+        '',
+        'def b():',
+        '    pass',
+    ], [(5, 'x = 1'), (7, ''), (5, 'x = """')]],
+}
+
+# ===============================================================================
+
+
+def load_mapper(name):
+    # a fresh module, so nothing is reused from the previous runs
+    module = SourceFileLoader('check_' + name, os.path.join(package_dir, 'custom_mappers', name + '.py')).load_module()
+    if hasattr(module, 'line_reader'):
+        module.line_reader = Mapper.read_lines
+    return module
+
+
+def write(file, lines):
+    with open(file, 'w', encoding='utf8') as f:
+        f.write('\n'.join(lines))
+
+
+def check(mapper, file, lines, edits):
+    """Applies the edits to the file mapped incrementally, returns the number of mismatches."""
+
+    write(file, lines)
+    mapper.generate(file)
+
+    mismatches = 0
+    for index, line in edits:
+        lines = lines[:index] + [line] + lines[index + 1:]
+        write(file, lines)
+        incremental = mapper.generate(file)
+        fresh = load_mapper('py').generate(file)
+        if incremental != fresh:
+            mismatches += 1
+            print('  mismatch after the edit of line {0}: {1!r}'.format(index + 1, line))
+            print('    incremental: {0!r}'.format(incremental))
+            print('    fresh:       {0!r}'.format(fresh))
+    return mismatches
+
+
+def random_edits(rng, lines, count):
+    """Line replacements taken from the file itself (plus some declarations and openers)."""
+
+    extra = ['def zz():', 'class Q:', '    def m(self):', '"""', 'x = (', 'pass', 'if X:', '    def b():']
+    return [(rng.randrange(len(lines)), rng.choice(lines + extra)) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Consistency check of the incremental CodeMap mappers.')
+    parser.add_argument('files', nargs='*', help='Python files to edit randomly (besides the fixtures)')
+    parser.add_argument('--edits', type=int, default=20, help='random edits per file')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    mismatches = checked = 0
+
+    with tempfile.TemporaryDirectory() as folder:
+        file = os.path.join(folder, 'check.py')
+
+        for name, (lines, edits) in sorted(fixtures.items()):
+            found = check(load_mapper('py'), file, lines, edits)
+            print('{0:<20} {1}'.format(name, 'ok' if not found else '{0} mismatches'.format(found)))
+            mismatches += found
+            checked += len(edits)
+
+        for source in args.files:
+            with open(source, 'r', encoding='utf8', errors='replace') as f:
+                lines = f.read().split('\n')
+            found = check(load_mapper('py'), file, lines, random_edits(rng, lines, args.edits))
+            if found:
+                print('{0}: {1} mismatches'.format(source, found))
+            mismatches += found
+            checked += args.edits
+
+    print('{0} edits, {1} mismatches'.format(checked, mismatches))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
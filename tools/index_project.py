@@ -0,0 +1,89 @@
+# Worker of the CodeMap project index (see "project_index" in CodeMap.sublime-settings).
+#
+# CodeMap runs several instances of this script with the "project_index_python" interpreter, so
+# the files are mapped outside of the editor and in parallel. The mappers are imported with the
+# `sublime` stand-in module from this folder. The request is a JSON object read from stdin:
+#
+#   {"settings": <the CodeMap settings the mappers depend on>,
+#    "custom_mappers": <the User/CodeMap/custom_mappers folder>,
+#    "files": [<file>, ...]}
+#
+# For every file a JSON line [file, [[name, kind, line], ...]] is written to stdout, with null in
+# place of the symbols if the file has no mapper or cannot be mapped.
+
+import json
+import os
+import sys
+from importlib.machinery import SourceFileLoader
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(tools_dir)
+
+sys.path.insert(0, tools_dir)
+sys.path.insert(1, package_dir)
+
+import sublime  # noqa: E402 (the stand-in from tools_dir)
+import code_map_support as Mapper  # noqa: E402
+
+# -----------------
+
+
+def custom_mapper(folder, extension, modules):
+    """Returns the custom mapper module for the extension (or None), loaded once."""
+
+    if extension not in modules:
+        module = None
+        script = os.path.join(folder, extension + '.py')
+        if os.path.isfile(script):
+            try:
+                module = SourceFileLoader('index_' + extension + '_mapper', script).load_module()
+                if hasattr(module, 'line_reader'):
+                    module.line_reader = Mapper.read_lines
+                if hasattr(module, 'map_depth'):
+                    module.map_depth = Mapper.map_depth
+            except Exception as err:
+                print('CodeMap index: cannot load custom mapper', script, err)
+        modules[extension] = module
+    return modules[extension]
+
+
+def map_file(file, folder, modules):
+    """Returns the [name, kind, line] of the symbols of the file, like CodeMap maps it: with the
+    universal mapper if the extension is in "syntaxes", otherwise with the custom mapper."""
+
+    extension = os.path.splitext(file)[1][1:].lower()
+
+    mapped = Mapper.universal_mapper.evaluate(file, extension)
+    if mapped:
+        result = mapped[0]
+    else:
+        module = custom_mapper(folder, extension, modules)
+        if not module:
+            return None
+        result = module.generate(file)
+
+    map, symbols = Mapper.render_map(result)
+    return [[sym.name, sym.kind, sym.line] for sym in symbols]
+
+
+def main():
+    request = json.loads(sys.stdin.buffer.read().decode('utf8'))
+    sublime.loaded_settings['CodeMap.sublime-settings'] = sublime.Settings(request['settings'])
+
+    # the mappers print their errors, stdout is reserved for the results
+    out = sys.stdout
+    sys.stdout = sys.stderr
+
+    modules = {}
+    for file in request['files']:
+        try:
+            symbols = map_file(file, request['custom_mappers'], modules)
+        except Exception as err:
+            print('CodeMap index:', file, err)
+            symbols = None
+        out.write(json.dumps([file, symbols]) + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':
+    main()
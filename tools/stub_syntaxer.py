@@ -0,0 +1,104 @@
+# Stand-in for the cs-script syntaxer, to test the C# mapping without cs-script.
+#
+# It answers the "codemap" requests CodeMap sends to the "syntaxer_port" of
+# cs-script.sublime-settings with the map of the classes, structs, interfaces, enums and methods
+# found (with a regex) in the requested file:
+#
+#   python3 tools/stub_syntaxer.py --port 18000
+#   python3 tools/stub_syntaxer.py --port 18000 --framing length
+#
+# Set "syntaxer_port": 18000 in cs-script.sublime-settings and, for "--framing length", also
+# "syntaxer_framing": "length" in CodeMap.sublime-settings. `--delay` (seconds) makes every
+# response late, e.g. to test the mapping timeouts.
+
+import argparse
+import re
+import socketserver
+import struct
+import time
+
+declaration = re.compile(r'^(\s*)(?:(?:public|private|protected|internal|static|abstract|sealed|partial|'
+                         r'virtual|override|async|readonly|unsafe|new)\s+)*'
+                         r'(?:(class|struct|interface|enum)\s+(\w+)|[\w<>\[\],.?]+\s+(\w+)\s*\()')
+
+
+def codemap(file):
+    lines = []
+    with open(file, 'r', encoding='utf-8-sig') as f:
+        for num, line in enumerate(f, 1):
+            match = declaration.match(line)
+            if not match or match.group(4) in ('if', 'for', 'foreach', 'while', 'switch', 'return', 'catch', 'using'):
+                continue
+            indent, kind, type_name, method = match.groups()
+            depth = len(indent.expandtabs(4)) // 4
+            name = '{0} {1}'.format(kind, type_name) if kind else method + '()'
+            lines.append('{0:<40}    :{1}'.format('    ' * depth + name, num))
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def respond(request):
+    options = dict(line[1:].split(':', 1) for line in request.splitlines() if line.startswith('-') and ':' in line)
+    if options.get('op') != 'codemap':
+        return 'Error: unsupported operation ' + str(options.get('op'))
+    try:
+        return codemap(options.get('script', ''))
+    except Exception as err:
+        return 'Error: {0}'.format(err)
+
+# -----------------
+
+
+class handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sock = self.request
+        if self.server.framing == 'length':
+            # a connection serves any number of requests
+            while True:
+                header = read_exactly(sock, 4)
+                if not header:
+                    return
+                request = read_exactly(sock, struct.unpack('>I', header)[0])
+                response = self.answer(request)
+                sock.sendall(struct.pack('>I', len(response)) + response)
+        else:
+            # one request per connection, the response ends when the connection is closed
+            sock.sendall(self.answer(sock.recv(64 * 1024)))
+
+    def answer(self, request):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        return respond(request.decode('utf-8')).encode('utf-8')
+
+
+def read_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in for the cs-script syntaxer.')
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--framing', choices=['close', 'length'], default='close')
+    parser.add_argument('--delay', type=float, default=0, help='seconds to wait before every response')
+    args = parser.parse_args()
+
+    with server(('localhost', args.port), handler) as syntaxer:
+        syntaxer.framing = args.framing
+        syntaxer.delay = args.delay
+        print('stub syntaxer on port {0} ({1} framing)'.format(args.port, args.framing))
+        syntaxer.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
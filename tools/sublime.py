@@ -0,0 +1,99 @@
+# Minimal stand-in for the Sublime Text `sublime` module.
+#
+# It lets the mappers (code_map_support.py and custom_mappers/*.py) be imported outside of
+# the editor, e.g. by bench_mappers.py. Only what the mappers use is implemented:
+# the package settings are read from the CodeMap.sublime-settings next to this folder,
+# any other settings file is empty.
+
+import json
+import os
+import re
+import tempfile
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+packages_dir = os.path.join(tempfile.gettempdir(), 'CodeMapPackages')
+
+# -----------------
+
+
+class Settings():
+
+    def __init__(self, values):
+        self.values = values
+        self.callbacks = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+        for callback in list(self.callbacks.values()):
+            callback()
+
+    def has(self, key):
+        return key in self.values
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+    def add_on_change(self, tag, callback):
+        self.callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self.callbacks.pop(tag, None)
+
+# -----------------
+
+
+class Region():
+
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+# -----------------
+
+
+loaded_settings = {}
+
+
+def read_settings(file):
+    # sublime-settings files are JSON with comments and trailing commas
+    with open(file, 'r', encoding='utf8') as f:
+        text = f.read()
+    text = re.sub(r'^\s*//.*$', '', text, flags=re.MULTILINE)
+    text = re.sub(r',(\s*[\]}])', r'\1', text)
+    return json.loads(text)
+
+
+def load_settings(name):
+    if name not in loaded_settings:
+        file = os.path.join(package_dir, name)
+        loaded_settings[name] = Settings(read_settings(file) if os.path.exists(file) else {})
+    return loaded_settings[name]
+
+
+def packages_path():
+    return packages_dir
+
+
+def set_timeout(callback, delay=0):
+    callback()
+
+
+def set_timeout_async(callback, delay=0):
+    callback()
+
+
+def status_message(message):
+    pass
+
+
+def version():
+    return '4000'